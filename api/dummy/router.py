@@ -1,16 +1,35 @@
-from fastapi import APIRouter
-from pydmart.enums import Status
+from typing import Annotated
+from uuid import uuid4
+
+from fastapi import APIRouter, Body, Header, Path, Query, Request
+from fastapi.responses import StreamingResponse
+from pydmart.enums import RequestType, Status
 from pydmart.models import ApiResponse, ActionResponse, ApiResponseRecord
 
-from api.dummy.services import get_dummies, insert_dummy, update_dummy, delete_dummy, get_dummy
-from models.dummy import DummyData
+from api.dummy.services import (
+    get_dummies, insert_dummy, update_dummy, delete_dummy, get_dummy, batch_dummies, dummy_record,
+    stream_dummies, upload_attachment, download_attachment
+)
+from models.dummy import DummyData, DummyBatchItem
+from utils import regex
+from utils.middleware import extend_deadline
+from utils.settings import settings
 
 
 router = APIRouter()
 
 @router.get("/", response_model=ApiResponse, response_model_exclude_none=True)
-async def fetch_all() -> ApiResponse:
-    return await get_dummies()
+async def fetch_all(
+    limit: Annotated[int, Query(ge=1, le=settings.dummy_page_max_limit)] = 10,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    cursor: str | None = None,
+) -> ApiResponse:
+    return await get_dummies(limit, offset, cursor)
+
+
+@router.get("/stream", response_class=StreamingResponse)
+async def stream_all() -> StreamingResponse:
+    return StreamingResponse(stream_dummies(settings.dummy_stream_page_size), media_type="application/x-ndjson")
 
 
 @router.post("/", response_model=ApiResponse, response_model_exclude_none=True)
@@ -19,6 +38,29 @@ async def create(dummy: DummyData) -> ApiResponse:
     return ApiResponse(status=Status.success, records=[ApiResponseRecord(shortname=one.shortname, resource_type=one.resource_type, subpath=one.subpath, attributes=one.attributes) for one in action.records])
 
 
+@router.post("/batch", response_model=ApiResponse, response_model_exclude_none=True)
+async def create_batch(dummies: Annotated[list[DummyData], Body(max_length=settings.dummy_batch_max_records)]) -> ApiResponse:
+    # Explicit full uuid shortnames, so every result can be matched to its record without collisions
+    return await batch_dummies(RequestType.create, [dummy_record(uuid4().hex, dummy) for dummy in dummies])
+
+
+@router.put("/batch", response_model=ApiResponse, response_model_exclude_none=True)
+async def update_batch(
+    dummies: Annotated[list[DummyBatchItem], Body(max_length=settings.dummy_batch_max_records)]
+) -> ApiResponse:
+    return await batch_dummies(
+        RequestType.update,
+        [dummy_record(dummy.shortname, DummyData(**dummy.model_dump(exclude={"shortname"}))) for dummy in dummies]
+    )
+
+
+@router.delete("/batch", response_model=ApiResponse, response_model_exclude_none=True)
+async def delete_batch(
+    shortnames: Annotated[list[Annotated[str, Body(pattern=regex.SHORTNAME)]], Body(max_length=settings.dummy_batch_max_records)]
+) -> ApiResponse:
+    return await batch_dummies(RequestType.delete, [dummy_record(shortname) for shortname in shortnames])
+
+
 @router.put("/{shortname}", response_model=ApiResponse, response_model_exclude_none=True)
 async def update(shortname: str, dummy: DummyData) -> ApiResponse:
     action : ActionResponse = await update_dummy(shortname, dummy)
@@ -34,3 +76,26 @@ async def delete(shortname: str) -> ApiResponse:
 @router.get("/{shortname}", response_model=ApiResponse, response_model_exclude_none=True)
 async def fetch_by_shortname(shortname: str) -> ApiResponse:
     return await get_dummy(shortname)
+
+
+@router.post("/{shortname}/attachments/{filename}", response_model=ApiResponse, response_model_exclude_none=True)
+async def upload(
+    request: Request,
+    shortname: Annotated[str, Path(pattern=regex.SHORTNAME)],
+    filename: Annotated[str, Path(pattern=regex.FILENAME)],
+    content_type: Annotated[str, Header()] = "application/octet-stream",
+    content_length: Annotated[int | None, Header()] = None,
+) -> ApiResponse:
+    # The raw file is the request body, it is streamed to DMART as it arrives
+    extend_deadline(settings.attachment_transfer_timeout)
+    return await upload_attachment(shortname, filename, content_type, content_length, request.stream())
+
+
+@router.get("/{shortname}/attachments/{filename}", response_class=StreamingResponse)
+async def download(
+    shortname: Annotated[str, Path(pattern=regex.SHORTNAME)],
+    filename: Annotated[str, Path(pattern=regex.FILENAME)],
+    range_header: Annotated[str | None, Header(alias="range")] = None,
+    if_range: Annotated[str | None, Header()] = None,
+) -> StreamingResponse:
+    return await download_attachment(shortname, filename, range_header, if_range)
@@ -1,11 +1,41 @@
-from pydmart.enums import ResourceType, RequestType, QueryType
-from pydmart.models import ApiResponse, ActionResponse, QueryRequest, ActionRequest, ActionRequestRecord
+import asyncio
+import base64
+import binascii
+import json
+from collections.abc import AsyncIterator
+from starlette.responses import StreamingResponse
+from fastapi import status
+from jsonschema.exceptions import ValidationError as SchemaValidationError
+from pydmart.enums import ResourceType, RequestType, QueryType, Status
+from pydmart.models import (
+    ApiResponse, ActionResponse, QueryRequest, ActionRequest, ActionRequestRecord, ApiResponseRecord,
+    DmartException, Error as DmartError
+)
 from models.dummy import DummyData
+from utils.attachments import ATTACHMENT_TYPES, limited, proxy_response, too_large
+from utils.cache import query_cache
 from utils.dmart import dmart
+from utils.internal_error_code import InternalErrorCode
+from utils.schemas import schema_registry
+from utils.settings import settings
+
+
+async def query(request: QueryRequest) -> ApiResponse:
+    return await query_cache.query(request, dmart.query)
+
+
+async def action(request: ActionRequest) -> ActionResponse:
+    try:
+        return await dmart.request(request)  # type: ignore
+    finally:
+        for record in request.records:
+            query_cache.invalidate(request.space_name, record.subpath)
 
 
 async def insert_dummy(data: DummyData) -> ActionResponse:
-    return await dmart.request(
+    body = data.model_dump()
+    schema_registry.validate("dummy_space", "dummy_schema", body)
+    return await action(
         ActionRequest(
             space_name="dummy_space",
             request_type=RequestType.create,
@@ -19,7 +49,7 @@ async def insert_dummy(data: DummyData) -> ActionResponse:
                         "payload": {
                             "content_type": "json",
                             "schema_shortname": "dummy_schema",
-                            "body": data.model_dump()
+                            "body": body
                         }
                     },
                     resource_type=ResourceType.content
@@ -29,23 +59,71 @@ async def insert_dummy(data: DummyData) -> ActionResponse:
 
     )
 
-async def get_dummies() -> ApiResponse:
-    response = await dmart.query(
-        QueryRequest(
-            type=QueryType.search,
-            space_name="dummy_space",
-            subpath="dummy_subpath",
-            search='',
-            retrieve_json_payload=True,
-            retrieve_attachments=True,
-        )
+def dummies_query(limit: int, offset: int) -> QueryRequest:
+    return QueryRequest(
+        type=QueryType.search,
+        space_name="dummy_space",
+        subpath="dummy_subpath",
+        search='',
+        retrieve_json_payload=True,
+        retrieve_attachments=True,
+        limit=limit,
+        offset=offset,
     )
-    print("response", response)
-    return response
+
+
+def encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    invalid = DmartException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        error=DmartError(type="request", code=InternalErrorCode.INVALID_DATA, message="Invalid cursor"),
+    )
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))["offset"]
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise invalid
+    if not isinstance(offset, int) or offset < 0:
+        raise invalid
+    return offset
+
+
+async def get_dummies(limit: int = 10, offset: int = 0, cursor: str | None = None) -> ApiResponse:
+    if cursor:
+        offset = decode_cursor(cursor)
+    response = await query(dummies_query(limit, offset))
+    if len(response.records) < limit:
+        return response
+    # Copy, the cached response is shared with other readers
+    return response.model_copy(update={"next_cursor": encode_cursor(offset + limit)})
+
+
+async def stream_dummies(page_size: int) -> AsyncIterator[bytes]:
+    """Yield all the dummies as NDJSON, the next page is fetched while the current one is sent"""
+    offset = 0
+    next_page: asyncio.Future | None = asyncio.ensure_future(dmart.query(dummies_query(page_size, offset)))
+    try:
+        while next_page is not None:
+            try:
+                response = await next_page
+            except DmartException as e:
+                yield ApiResponse(status=Status.failed, error=e.error).model_dump_json(exclude_none=True).encode() + b"\n"
+                return
+            offset += page_size
+            next_page = None
+            if len(response.records) == page_size:
+                next_page = asyncio.ensure_future(dmart.query(dummies_query(page_size, offset)))
+            for record in response.records:
+                yield record.model_dump_json(exclude_none=True).encode() + b"\n"
+    finally:
+        if next_page is not None:
+            next_page.cancel()
 
 
 async def get_dummy(shortname: str) -> ApiResponse:
-    response = await dmart.query(
+    response = await query(
         QueryRequest(
             type=QueryType.search,
             space_name="dummy_space",
@@ -59,7 +137,9 @@ async def get_dummy(shortname: str) -> ApiResponse:
     return response
 
 async def update_dummy(shortname: str, data: DummyData) -> ActionResponse:
-    return await dmart.request(
+    body = data.model_dump()
+    schema_registry.validate("dummy_space", "dummy_schema", body)
+    return await action(
         ActionRequest(
             space_name="dummy_space",
             request_type=RequestType.update,
@@ -73,7 +153,7 @@ async def update_dummy(shortname: str, data: DummyData) -> ActionResponse:
                         "payload": {
                             "content_type": "json",
                             "schema_shortname": "dummy_schema",
-                            "body": data.model_dump()
+                            "body": body
                         }
                     },
                     resource_type=ResourceType.content
@@ -83,7 +163,7 @@ async def update_dummy(shortname: str, data: DummyData) -> ActionResponse:
     )
 
 async def delete_dummy(shortname: str) -> ActionResponse:
-    return await dmart.request(
+    return await action(
         ActionRequest(
             space_name="dummy_space",
             request_type=RequestType.delete,
@@ -97,3 +177,148 @@ async def delete_dummy(shortname: str) -> ActionResponse:
             ]
         )
     )
+
+
+def dummy_record(shortname: str, data: DummyData | None = None) -> ActionRequestRecord:
+    attributes = {}
+    if data is not None:
+        attributes = {
+            "is_active": True,
+            "relationships": [],
+            "payload": {
+                "content_type": "json",
+                "schema_shortname": "dummy_schema",
+                "body": data.model_dump()
+            }
+        }
+    return ActionRequestRecord(
+        shortname=shortname,
+        subpath="dummy_subpath",
+        attributes=attributes,
+        resource_type=ResourceType.content
+    )
+
+
+def failed_shortnames(error: DmartError) -> set[str] | None:
+    """Shortnames DMART reported as failed in a multi record request, None if it did not tell"""
+    failed: set[str] = set()
+    for info in error.info or []:
+        for one in info.get("failed", []) if isinstance(info, dict) else []:
+            record = one.get("record", one) if isinstance(one, dict) else one
+            shortname = record.get("shortname") if isinstance(record, dict) else record
+            if isinstance(shortname, str):
+                failed.add(shortname)
+    return failed or None
+
+
+def batch_result(
+    record: ActionRequestRecord, error: DmartError | None, attributes: dict | None = None
+) -> ApiResponseRecord:
+    return ApiResponseRecord(
+        shortname=record.shortname,
+        subpath=record.subpath,
+        resource_type=record.resource_type,
+        attributes=(
+            {"status": Status.failed, "error": error.model_dump()}
+            if error else {"status": Status.success, **(attributes or {})}
+        ),
+    )
+
+
+def schema_error(record: ActionRequestRecord) -> DmartError | None:
+    """Why the record's payload fails the local schema check, None when it passes or has none"""
+    body = record.attributes.get("payload", {}).get("body")
+    if body is None:
+        return None
+    try:
+        schema_registry.validate("dummy_space", "dummy_schema", body)
+    except SchemaValidationError as e:
+        return DmartError(
+            type="validation", code=422, message="Validation error [3]", info=[{"loc": list(e.path), "msg": e.message}]
+        )
+    return None
+
+
+async def batch_chunk(request_type: RequestType, chunk: list[ActionRequestRecord]) -> list[ApiResponseRecord]:
+    try:
+        response = await action(ActionRequest(space_name="dummy_space", request_type=request_type, records=chunk))
+    except DmartException as e:
+        failed = failed_shortnames(e.error)
+        return [
+            batch_result(record, e.error if failed is None or record.shortname in failed else None)
+            for record in chunk
+        ]
+    returned = {one.shortname: one.attributes for one in response.records}
+    return [batch_result(record, None, returned.get(record.shortname)) for record in chunk]
+
+
+async def batch_dummies(request_type: RequestType, records: list[ActionRequestRecord]) -> ApiResponse:
+    """Send the records as multi record requests of `dummy_batch_chunk_size`, a few chunks at a time"""
+    semaphore = asyncio.Semaphore(settings.dummy_batch_concurrency)
+    size = settings.dummy_batch_chunk_size
+
+    async def send(chunk: list[ActionRequestRecord]) -> list[ApiResponseRecord]:
+        async with semaphore:
+            return await batch_chunk(request_type, chunk)
+
+    # Records failing the local schema check are reported as such and not sent
+    rejected = {index: error for index, record in enumerate(records) if (error := schema_error(record)) is not None}
+    valid = [record for index, record in enumerate(records) if index not in rejected]
+    chunks = await asyncio.gather(*[send(valid[i:i + size]) for i in range(0, len(valid), size)])
+    sent = iter([result for chunk in chunks for result in chunk])
+    results = [
+        batch_result(record, rejected[index]) if index in rejected else next(sent) for index, record in enumerate(records)
+    ]
+    failed = sum(1 for result in results if result.attributes["status"] == Status.failed)
+    if not failed:
+        return ApiResponse(status=Status.success, records=results)
+    return ApiResponse(
+        status=Status.failed,
+        error=DmartError(
+            type="batch", code=InternalErrorCode.SOMETHING_WRONG, message=f"{failed} of {len(results)} records failed"
+        ),
+        records=results,
+    )
+
+
+async def upload_attachment(
+    shortname: str, file_name: str, content_type: str, content_length: int | None, body: AsyncIterator[bytes]
+) -> ApiResponse:
+    """Stream an attachment of the dummy `shortname` to DMART, `file_name` matches regex.FILENAME"""
+    if content_length is not None and content_length > settings.attachment_max_bytes:
+        raise too_large(settings.attachment_max_bytes)
+    attachment_shortname, _, ext = file_name.rpartition(".")
+    resource_type, payload_content_type = ATTACHMENT_TYPES[ext.lower()]
+    subpath = f"dummy_subpath/{shortname}"
+    payload: dict = {"body": file_name}
+    if payload_content_type is not None:
+        payload["content_type"] = payload_content_type
+    record = {
+        "resource_type": resource_type,
+        "subpath": subpath,
+        "shortname": attachment_shortname,
+        "attributes": {"is_active": True, "payload": payload},
+    }
+    try:
+        return await dmart.upload(
+            "dummy_space", record, file_name, content_type, limited(body, settings.attachment_max_bytes)
+        )
+    finally:
+        query_cache.invalidate("dummy_space", subpath)
+
+
+async def download_attachment(
+    shortname: str, file_name: str, range_header: str | None, if_range: str | None
+) -> StreamingResponse:
+    """Stream an attachment of the dummy `shortname` from DMART, a Range is passed on or applied here"""
+    attachment_shortname, _, ext = file_name.rpartition(".")
+    resource_type, _ = ATTACHMENT_TYPES[ext.lower()]
+    headers = {}
+    if range_header:
+        headers["Range"] = range_header
+        if if_range:
+            headers["If-Range"] = if_range
+    response = await dmart.open_payload(
+        f"{resource_type}/dummy_space/dummy_subpath/{shortname}/{attachment_shortname}.{ext}", headers
+    )
+    return proxy_response(response, settings.attachment_chunk_size, range_header, if_range)
@@ -0,0 +1,100 @@
+"""Microbenchmark of the channel routing check at 1, 50 and 500 channels
+
+Compares the compiled ChannelIndex lookup, as the request middleware runs it, against the
+previous per-request scan of every channel and pattern (reproduced below as `legacy_middleware`).
+
+    python -m loadtest.bench_channel_middleware
+"""
+import asyncio
+import re
+import time
+from typing import Any
+
+from starlette.requests import Request
+
+from utils.middleware import ChannelIndex
+from utils.settings import settings
+
+
+async def app(scope, receive, send):
+    pass
+
+
+def legacy_middleware(app):
+    async def middleware(scope, receive, send):
+        request = Request(scope, receive)
+        channel_key = request.headers.get("x-channel-key")
+        if not channel_key:
+            for channel in settings.channels:
+                for pattern in channel["allowed_api_patterns"]:
+                    if pattern.search(request.scope['path']):
+                        raise PermissionError()
+            await app(scope, receive, send)
+            return
+
+        request_channel: dict[str, Any] | None = None
+        for channel in settings.channels:
+            if channel_key in channel.get("keys", []):
+                request_channel = channel
+                break
+        if not request_channel:
+            raise PermissionError()
+        for pattern in request_channel["allowed_api_patterns"]:
+            if pattern.search(request.scope['path']):
+                await app(scope, receive, send)
+                return
+        raise PermissionError()
+    return middleware
+
+
+def indexed_middleware(app):
+    index = ChannelIndex(settings.channels)
+
+    async def middleware(scope, receive, send):
+        index.check(scope)
+        await app(scope, receive, send)
+    return middleware
+
+
+def make_channels(count: int) -> list:
+    return [
+        {
+            "keys": [f"key-{i}-{k}" for k in range(5)],
+            "allowed_api_patterns": [re.compile(f"^/channel{i}/route{p}/") for p in range(5)],
+        }
+        for i in range(count)
+    ]
+
+
+def scopes(count: int) -> list[dict]:
+    headers = [(b"host", b"localhost"), (b"accept", b"*/*"), (b"user-agent", b"bench")]
+    last = count - 1
+    return [
+        # Guest request to an unrestricted path, has to be checked against every pattern
+        {"type": "http", "path": "/dummy/", "headers": headers},
+        # The last channel's key, the worst case of the linear scan
+        {"type": "http", "path": f"/channel{last}/route4/x", "headers": headers + [(b"x-channel-key", f"key-{last}-4".encode())]},
+    ]
+
+
+async def run(middleware, requests: list[dict], rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for scope in requests:
+            await middleware(scope, None, None)
+    return (time.perf_counter() - start) / (rounds * len(requests)) * 1e6
+
+
+async def main():
+    rounds = 2000
+    print(f"{'channels':>8} {'legacy us/req':>14} {'indexed us/req':>15} {'speedup':>8}")
+    for count in (1, 50, 500):
+        settings.channels = make_channels(count)
+        requests = scopes(count)
+        legacy = await run(legacy_middleware(app), requests, rounds)
+        indexed = await run(indexed_middleware(app), requests, rounds)
+        print(f"{count:>8} {legacy:>14.2f} {indexed:>15.2f} {legacy / indexed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""Throughput and memory of the Argon2 hashing service at several concurrency caps
+
+For each cap a fresh `HashingService` verifies `--count` passwords submitted all at once,
+while a timer on the event loop records how late it fires. Reports hashes per second, the
+peak RSS of this process and its pool processes, and the worst loop lag. The same work
+done inline (the plain `verify_password`) is measured first for comparison.
+
+    python -m loadtest.bench_hashing --concurrency 1 2 4 8 --count 32
+    python -m loadtest.bench_hashing --executor process
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from loadtest.bench_http import rss_mb
+from utils.password_hashing import HashingService, hash_password, verify_password
+
+
+async def measure(work: Callable[[], Awaitable[Any]]) -> dict[str, float]:
+    loop = asyncio.get_running_loop()
+    peak = rss_mb(os.getpid())
+    worst_lag = 0.0
+    done = False
+
+    async def watch() -> None:
+        nonlocal peak, worst_lag
+        while not done:
+            start = loop.time()
+            await asyncio.sleep(0.01)
+            worst_lag = max(worst_lag, loop.time() - start - 0.01)
+            peak = max(peak, rss_mb(os.getpid()))
+
+    watcher = asyncio.create_task(watch())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await work()
+    elapsed = time.perf_counter() - start
+    done = True
+    await watcher
+    return {"seconds": elapsed, "peak_rss_mb": peak, "max_loop_lag_ms": worst_lag * 1000}
+
+
+async def bench(args) -> dict[str, Any]:
+    hashed = hash_password("correct horse battery staple")
+    result: dict[str, Any] = {"count": args.count, "executor": args.executor, "runs": {}}
+
+    async def inline() -> None:
+        for _ in range(args.count):
+            verify_password("correct horse battery staple", hashed)
+
+    result["runs"]["inline"] = await measure(inline)
+    for concurrency in args.concurrency:
+        service = HashingService(concurrency, args.count, 600, args.executor)
+        # Start the pool outside the measurement, process pools fork on first use
+        await service.verify("correct horse battery staple", hashed)
+
+        async def pooled(service: HashingService = service) -> None:
+            results = await asyncio.gather(
+                *[service.verify("correct horse battery staple", hashed) for _ in range(args.count)]
+            )
+            if not all(ok for ok, _ in results):
+                raise SystemExit("A verification failed")
+
+        result["runs"][concurrency] = await measure(pooled)
+        service.close()
+    for run in result["runs"].values():
+        run["hashes_per_second"] = args.count / run["seconds"]
+    return result
+
+
+def report(result: dict[str, Any]) -> None:
+    print(f"{result['count']} verifications, {result['executor']} pool")
+    print(f"{'concurrency':>12} {'hashes/s':>9} {'peak RSS':>9} {'max loop lag':>13}")
+    for concurrency, run in result["runs"].items():
+        print(
+            f"{concurrency:>12} {run['hashes_per_second']:>9.1f} {run['peak_rss_mb']:>7.0f}MB"
+            f" {run['max_loop_lag_ms']:>11.0f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(__doc__ or "").partition("\n")[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 2])
+    parser.add_argument("--count", type=int, default=32, help="Verifications per concurrency level")
+    parser.add_argument("--executor", choices=("thread", "process"), default="thread")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+    result = asyncio.run(bench(args))
+    report(result)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
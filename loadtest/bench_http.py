@@ -0,0 +1,382 @@
+"""Load test of `main:app` served by hypercorn against the local DMART stub
+
+Starts `loadtest.dmart_stub` and `hypercorn main:app` as subprocesses, drives them with
+`--concurrency` clients for `--duration` seconds using a weighted `--mix` of requests,
+then reports throughput, latency percentiles (overall and per scenario), the RSS of the
+server processes and the event loop lag the workers recorded in /metrics.
+
+    python -m loadtest.bench_http --duration 20 --concurrency 64 --output results.json
+    python -m loadtest.bench_http --baseline results.json --tolerance 0.1
+
+With --baseline the run is compared to a previous --output file and the command exits
+with 1 when throughput dropped or a latency percentile grew by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from typing import Any
+
+import aiohttp
+
+from utils.jwt import generate_jwt
+from utils.settings import settings
+
+DEFAULT_MIX = "list=4,get=3,create=1,update=1,delete=1,notfound=1,options=1"
+JWT_SECRET = "loadtest-secret-long-enough-for-hs256"
+DUMMY = {"mere_string": "load", "mere_int": 1, "mere_float": 1.5, "mere_bool": True, "mere_dict": {"a": 1}}
+
+Request = tuple[str, str, dict[str, Any]]
+
+
+class Pool:
+    """Shortnames created during the run, updates and deletes pick from here"""
+
+    def __init__(self):
+        self.shortnames: list[str] = ["dummy_data"]
+
+    def pick(self) -> str | None:
+        return random.choice(self.shortnames) if self.shortnames else None
+
+    def take(self) -> str | None:
+        return self.shortnames.pop(random.randrange(len(self.shortnames))) if len(self.shortnames) > 1 else None
+
+
+def list_dummies(pool: Pool) -> Request:
+    return "GET", "/dummy/", {"params": {"limit": 10}}
+
+
+def get_dummy(pool: Pool) -> Request:
+    return "GET", f"/dummy/{pool.pick() or 'dummy_data'}", {}
+
+
+def create_dummy(pool: Pool) -> Request:
+    return "POST", "/dummy/", {"json": DUMMY}
+
+
+def update_dummy(pool: Pool) -> Request:
+    return "PUT", f"/dummy/{pool.pick() or 'dummy_data'}", {"json": DUMMY}
+
+
+def delete_dummy(pool: Pool) -> Request:
+    shortname = pool.take()
+    if shortname is None:
+        # Nothing created yet that can go
+        return get_dummy(pool)
+    return "DELETE", f"/dummy/{shortname}", {}
+
+
+def not_found(pool: Pool) -> Request:
+    return "GET", f"/missing/{random.randrange(1000)}", {}
+
+
+def preflight(pool: Pool) -> Request:
+    return "OPTIONS", "/dummy/", {
+        "headers": {"Origin": "http://localhost", "Access-Control-Request-Method": "POST"}
+    }
+
+
+SCENARIOS: dict[str, Callable[[Pool], Request]] = {
+    "list": list_dummies,
+    "get": get_dummy,
+    "create": create_dummy,
+    "update": update_dummy,
+    "delete": delete_dummy,
+    "notfound": not_found,
+    "options": preflight,
+}
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            sys.exit(f"Unknown scenario {name}, pick from {', '.join(SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+def summarize(latencies: list[float]) -> dict[str, float]:
+    latencies = sorted(latencies)
+    return {
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "max": (latencies[-1] if latencies else 0.0) * 1000,
+        "mean": (sum(latencies) / len(latencies) if latencies else 0.0) * 1000,
+    }
+
+
+def process_tree(pid: int) -> list[int]:
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            for child in file.read().split():
+                pids.extend(process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+def rss_mb(pid: int) -> float:
+    """Resident memory of `pid` and its children (the hypercorn workers), Linux only"""
+    total = 0
+    for one in process_tree(pid):
+        try:
+            with open(f"/proc/{one}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def loop_lag_ms(metrics: str) -> dict[str, float]:
+    """Mean and an upper bound of p99 from the merged event_loop_lag_seconds histogram"""
+    buckets: list[tuple[float, float]] = []
+    total = count = 0.0
+    for line in metrics.splitlines():
+        if line.startswith("event_loop_lag_seconds_bucket"):
+            bound = line.split('le="')[1].split('"')[0]
+            buckets.append((float(bound), float(line.rsplit(" ", 1)[1])))
+        elif line.startswith("event_loop_lag_seconds_sum"):
+            total = float(line.rsplit(" ", 1)[1])
+        elif line.startswith("event_loop_lag_seconds_count"):
+            count = float(line.rsplit(" ", 1)[1])
+    p99 = next((bound for bound, cumulative in buckets if count and cumulative >= 0.99 * count), 0.0)
+    return {"mean": total / count * 1000 if count else 0.0, "p99": p99 * 1000, "samples": count}
+
+
+async def wait_ready(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    sys.exit(f"{url} did not come up in {timeout}s")
+
+
+def start_stub(args, output) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    stub = subprocess.Popen(
+        [
+            sys.executable, "-m", "loadtest.dmart_stub", "--port", str(port),
+            "--latency", str(args.latency), "--jitter", str(args.jitter), "--error-rate", str(args.error_rate),
+        ],
+        stdout=output, stderr=subprocess.STDOUT,
+    )
+    return stub, f"http://127.0.0.1:{port}"
+
+
+def start_app(stub_url: str, workers: int, workdir: str, output) -> tuple[subprocess.Popen, str]:
+    """`hypercorn main:app` with its state (logs, metrics, rate limits) kept in `workdir`"""
+    port = free_port()
+    env = {
+        **os.environ,
+        "DMART_BASE_URL": stub_url,
+        "DMART_USERNAME": "loadtest",
+        "DMART_PASSWORD": "loadtest",
+        "JWT_SECRET": JWT_SECRET,
+        "LISTENING_PORT": str(port),
+        "LOG_FILE": os.path.join(workdir, "logs", "dmart.ljson.log"),
+        "LOG_HANDLERS": '["file"]',
+        "METRICS_DIR": os.path.join(workdir, "metrics"),
+        "METRICS_PUBLISH_INTERVAL": "1",
+        "RATE_LIMIT_FILE": os.path.join(workdir, "rate_limits.bin"),
+        "QUERY_CACHE_GENERATIONS_FILE": os.path.join(workdir, "query_cache_generations.bin"),
+    }
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "hypercorn", "main:app", "--config", "file:utils/hypercorn_config.py",
+            "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+        ],
+        env=env, stdout=output, stderr=subprocess.STDOUT,
+    )
+    return server, f"http://127.0.0.1:{port}"
+
+
+def stop(*processes: subprocess.Popen) -> None:
+    for process in processes:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+async def drive(args, base_url: str, server_pid: int) -> dict[str, Any]:
+    weights = parse_mix(args.mix)
+    names, cumulative = list(weights), list(weights.values())
+    settings.jwt_secret = JWT_SECRET
+    token = generate_jwt({"shortname": "loadtest", "type": "web"})
+    pool = Pool()
+    samples: dict[str, list[float]] = {name: [] for name in names}
+    statuses: dict[str, dict[str, int]] = {name: {} for name in names}
+    errors = 0
+    rss: list[float] = []
+    start = time.perf_counter()
+    measure_from = start + args.warmup
+    end = measure_from + args.duration
+
+    async def client(session: aiohttp.ClientSession) -> None:
+        nonlocal errors
+        while (now := time.perf_counter()) < end:
+            name = random.choices(names, cumulative)[0]
+            method, path, kwargs = SCENARIOS[name](pool)
+            if random.random() < args.auth_ratio:
+                kwargs = {**kwargs, "headers": {**kwargs.get("headers", {}), "Authorization": f"Bearer {token}"}}
+            try:
+                async with session.request(method, base_url + path, **kwargs) as response:
+                    body = await response.read()
+                    status = response.status
+            except aiohttp.ClientError:
+                if now >= measure_from:
+                    errors += 1
+                continue
+            if name == "create" and status == 200:
+                pool.shortnames.extend(record["shortname"] for record in json.loads(body).get("records", []))
+            if now >= measure_from:
+                samples[name].append(time.perf_counter() - now)
+                statuses[name][str(status)] = statuses[name].get(str(status), 0) + 1
+
+    async def sample_rss() -> None:
+        while True:
+            rss.append(rss_mb(server_pid))
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.create_task(sample_rss())
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[client(session) for _ in range(args.concurrency)])
+        sampler.cancel()
+        # Give every worker a publish interval to write its last snapshot
+        await asyncio.sleep(1.5)
+        async with session.get(f"{base_url}/metrics") as response:
+            metrics = await response.text()
+
+    latencies = [one for values in samples.values() for one in values]
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / args.duration,
+        "latency_ms": summarize(latencies),
+        "scenarios": {
+            name: {"requests": len(samples[name]), "statuses": statuses[name], "latency_ms": summarize(samples[name])}
+            for name in names
+        },
+        "rss_mb": {"peak": max(rss, default=0.0), "end": rss[-1] if rss else 0.0},
+        "loop_lag_ms": loop_lag_ms(metrics),
+    }
+
+
+def compare(result: dict[str, Any], baseline: dict[str, Any], tolerance: float) -> list[str]:
+    regressions = []
+
+    def check(label: str, current: float, previous: float, higher_is_better: bool = False) -> None:
+        if not previous:
+            return
+        change = (current - previous) / previous
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        print(f"  {label:32} {previous:10.2f} -> {current:10.2f} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+        if worse:
+            regressions.append(label)
+
+    print("Compared to baseline:")
+    check("throughput (req/s)", result["throughput"], baseline["throughput"], higher_is_better=True)
+    for key in ("p50", "p95", "p99"):
+        check(f"latency {key} (ms)", result["latency_ms"][key], baseline["latency_ms"][key])
+    for name, scenario in result["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous:
+            check(f"{name} p95 (ms)", scenario["latency_ms"]["p95"], previous["latency_ms"]["p95"])
+    return regressions
+
+
+def report(result: dict[str, Any]) -> None:
+    latency = result["latency_ms"]
+    print(
+        f"{result['requests']} requests, {result['errors']} errors, {result['throughput']:.1f} req/s, "
+        f"p50 {latency['p50']:.2f} ms, p95 {latency['p95']:.2f} ms, p99 {latency['p99']:.2f} ms"
+    )
+    for name, scenario in result["scenarios"].items():
+        latency = scenario["latency_ms"]
+        print(
+            f"  {name:10} {scenario['requests']:7} p50 {latency['p50']:7.2f} p95 {latency['p95']:7.2f} "
+            f"p99 {latency['p99']:7.2f} ms  {scenario['statuses']}"
+        )
+    print(f"RSS peak {result['rss_mb']['peak']:.1f} MB, end {result['rss_mb']['end']:.1f} MB")
+    print(f"Event loop lag mean {result['loop_lag_ms']['mean']:.2f} ms, p99 <= {result['loop_lag_ms']['p99']:.2f} ms")
+
+
+async def measure(args, stub_url: str, base_url: str, server_pid: int) -> dict[str, Any]:
+    await wait_ready(f"{stub_url}/user/login")
+    await wait_ready(f"{base_url}/")
+    return await drive(args, base_url, server_pid)
+
+
+def bench(args) -> int:
+    # Only the measurement runs on the event loop, the servers and files are handled around it
+    with tempfile.TemporaryDirectory() as workdir, open(os.path.join(workdir, "servers.log"), "w") as output:
+        stub, stub_url = start_stub(args, output)
+        server, base_url = start_app(stub_url, args.workers, workdir, output)
+        try:
+            result = asyncio.run(measure(args, stub_url, base_url, server.pid))
+        finally:
+            stop(server, stub)
+
+    report(result)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(__doc__ or "").partition("\n")[0])
+    parser.add_argument("--duration", type=float, default=10, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds driven before measuring")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Scenario weights, default {DEFAULT_MIX}")
+    parser.add_argument("--auth-ratio", type=float, default=0.5, help="Fraction of requests sent with a JWT")
+    parser.add_argument("--workers", type=int, default=2, help="Hypercorn workers")
+    parser.add_argument("--latency", type=float, default=0, help="DMART stub latency, in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="DMART stub jitter, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of DMART stub calls failed")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with the results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative change before it counts")
+    sys.exit(bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
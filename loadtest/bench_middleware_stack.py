@@ -0,0 +1,180 @@
+"""Per-request overhead of the middleware stack around `main:app`
+
+Drives the ASGI app in-process (no server, no network) and subtracts the time the same
+requests take through an app with the same routes but no user middleware, leaving what
+the middleware stack costs per request. The stack RequestMiddleware replaced is rebuilt
+below (`legacy_stack`) over the same routes for comparison: CorrelationIdMiddleware, the
+BaseHTTPMiddleware `middle` buffering the response, CustomRequestMiddleware, the linear
+ChannelMiddleware and the json_logging request instrumentation.
+
+    python -m loadtest.bench_middleware_stack [requests]
+"""
+import asyncio
+import json
+import logging
+import sys
+import time
+
+import json_logging
+from asgi_correlation_id import CorrelationIdMiddleware
+from fastapi import FastAPI, Request
+from starlette.concurrency import iterate_in_threadpool
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+import main
+from loadtest.bench_channel_middleware import (
+    legacy_middleware as legacy_channel_middleware,
+)
+from utils.jwt import JWTBearer
+from utils.middleware import reset_request_data, set_request_data
+from utils.settings import settings
+
+REQUESTS = [
+    ("GET", "/"),
+    ("OPTIONS", "/dummy/"),
+]
+
+
+def make_scope(method: str, path: str) -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"localhost"), (b"accept", b"*/*"), (b"user-agent", b"bench")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8282),
+        "state": {},
+        "app": main.app,
+    }
+
+
+async def receive() -> dict:
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message: dict) -> None:
+    pass
+
+
+class LegacyRequestData:
+    """CustomRequestMiddleware as it was: a Request built to copy the headers into a context variable"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        request = Request(scope, receive)
+        headers = [(k.encode(), v.encode()) for k, v in request.headers.items() if k not in ["cookie", "authorization"]]
+        token = set_request_data({"headers": headers})
+        await self.app(scope, receive, send)
+        reset_request_data(token)
+
+
+class LegacyChannel:
+    """ChannelMiddleware as it was, a scan of every channel and pattern per request"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = legacy_channel_middleware(app)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.app(scope, receive, send)
+
+
+async def legacy_middle(request: Request, call_next):
+    """The BaseHTTPMiddleware `middle` as it was, the whole response is buffered to be logged"""
+    start_time = time.time()
+    response_body: str | dict = {}
+    exception_data = None
+    try:
+        response = await asyncio.wait_for(call_next(request), timeout=settings.request_timeout)
+        response.headers["correlation_id"] = json_logging.get_correlation_id()
+        raw_response = [section async for section in response.body_iterator]
+        response.body_iterator = iterate_in_threadpool(iter(raw_response))
+        raw_data = b"".join(raw_response)
+        if raw_data:
+            try:
+                response_body = json.loads(raw_data)
+            except ValueError:
+                response_body = {}
+    except Exception as e:  # noqa: BLE001 - mirrors the old catch-all
+        response, response_body, exception_data = main.set_error_response(e)
+    main.set_middleware_response_headers(request.headers, response.headers)
+    user_shortname = "guest"
+    try:
+        user_shortname = str(await JWTBearer().__call__(request))
+    except Exception:  # noqa: BLE001, S110 - as the old middleware did
+        pass
+    extra = main.set_middleware_extra(
+        request, response.status_code, response.headers, start_time, user_shortname, exception_data, response_body
+    )
+    level = main.get_log_level(response.status_code, request.method, exception_data)
+    if level is not None:
+        main.set_logging(level, main.mask_sensitive_data(extra))
+    return response
+
+
+class NullStream:
+    def write(self, text: str) -> int:
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+
+def legacy_stack(routes_app: FastAPI) -> ASGIApp:
+    legacy = FastAPI()
+    legacy.router.routes = routes_app.router.routes
+    legacy.exception_handlers = routes_app.exception_handlers
+    # In the order main.py added them, each one wraps the previous
+    legacy.add_middleware(LegacyRequestData)
+    legacy.add_middleware(LegacyChannel)
+    legacy.add_middleware(BaseHTTPMiddleware, dispatch=legacy_middle)
+    legacy.add_middleware(
+        CorrelationIdMiddleware, header_name="X-Correlation-ID", update_request_header=False, validator=None
+    )
+    json_logging.init_request_instrument(legacy)
+    # The request log lines went to stdout, they are still formatted and written, to nowhere
+    for handler in json_logging.get_request_logger().handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(NullStream())
+    return legacy.build_middleware_stack()
+
+
+async def run(app, count: int) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        method, path = REQUESTS[i % len(REQUESTS)]
+        await app(make_scope(method, path), receive, send)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+async def bench(count: int):
+    # Served requests are logged, keep the writes out of the measurement
+    logging.getLogger("fastapi").setLevel(logging.CRITICAL)
+    logging.getLogger("json_logging").setLevel(logging.CRITICAL)
+    bare_app = FastAPI()
+    bare_app.router.routes = main.app.router.routes
+    bare_app.exception_handlers = main.app.exception_handlers
+    bare_stack = bare_app.build_middleware_stack()
+    old_stack = legacy_stack(main.app)
+    stack = main.app.build_middleware_stack()
+    await run(old_stack, 200)
+    await run(stack, 200)
+    bare = await run(bare_stack, count)
+    old = await run(old_stack, count)
+    full = await run(stack, count)
+    print(f"{'':16} {'us/request':>10} {'overhead':>10}")
+    print(f"{'no middleware':16} {bare:10.1f}")
+    print(f"{'legacy stack':16} {old:10.1f} {old - bare:10.1f}")
+    print(f"{'current stack':16} {full:10.1f} {full - bare:10.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(bench(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
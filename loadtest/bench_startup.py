@@ -0,0 +1,129 @@
+"""Startup time of `main:app` served by hypercorn against the local DMART stub
+
+For each worker count the server is started `--repeat` times and timed from the spawn
+to the first answered request, to every worker having finished its lifespan startup
+(each publishes its metrics snapshot right after) and to the first /openapi.json, which
+is built on demand. The cost of `import main` alone is measured in a fresh interpreter.
+
+    python -m loadtest.bench_startup --workers 1 4 --repeat 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import IO, Any
+
+import aiohttp
+
+from loadtest.bench_http import start_app, start_stub, stop, wait_ready
+from utils.settings import settings
+
+
+async def wait_workers(metrics_dir: str, workers: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.isdir(metrics_dir) and len([f for f in os.listdir(metrics_dir) if f.endswith(".json")]) >= workers:
+            return
+        await asyncio.sleep(0.01)
+    sys.exit(f"{workers} workers did not start in {timeout}s")
+
+
+async def first_response(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        await response.read()
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.01)
+    sys.exit(f"{url} did not answer in {timeout}s")
+
+
+async def start_once(stub_url: str, workers: int, output) -> dict[str, float]:
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as workdir:
+        started = time.monotonic()
+        server, base_url = start_app(stub_url, workers, workdir, output)
+        try:
+            await first_response(f"{base_url}/")
+            first_request = time.monotonic() - started
+            await wait_workers(os.path.join(workdir, "metrics"), workers)
+            all_workers = time.monotonic() - started
+            openapi_started = time.monotonic()
+            await first_response(f"{base_url}{settings.base_path}/openapi.json")
+            openapi = time.monotonic() - openapi_started
+        finally:
+            stop(server)
+    return {"first_request_s": first_request, "all_workers_s": all_workers, "first_openapi_s": openapi}
+
+
+def import_time(repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"],
+            capture_output=True, text=True, check=True,
+        )
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+async def time_starts(args, stub_url: str, output: IO[str]) -> dict[int, dict[str, float]]:
+    await wait_ready(f"{stub_url}/user/login")
+    times = {}
+    for workers in args.workers:
+        runs = [await start_once(stub_url, workers, output) for _ in range(args.repeat)]
+        times[workers] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    return times
+
+
+def bench(args) -> dict[str, Any]:
+    result: dict[str, Any] = {"import_main_s": import_time(args.repeat)}
+    with (
+        tempfile.TemporaryDirectory(prefix="bench-startup-") as workdir,
+        open(os.path.join(workdir, "servers.log"), "w") as output,
+    ):
+        stub, stub_url = start_stub(args, output)
+        try:
+            result["workers"] = asyncio.run(time_starts(args, stub_url, output))
+        finally:
+            stop(stub)
+    return result
+
+
+def report(result: dict[str, Any]) -> None:
+    print(f"import main: {result['import_main_s'] * 1000:.0f}ms")
+    print(f"{'workers':>8} {'first request':>14} {'all workers':>12} {'first openapi':>14}")
+    for workers, times in result["workers"].items():
+        print(
+            f"{workers:>8} {times['first_request_s'] * 1000:>12.0f}ms {times['all_workers_s'] * 1000:>10.0f}ms"
+            f" {times['first_openapi_s'] * 1000:>12.0f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(__doc__ or "").partition("\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 2], help="Worker counts to time")
+    parser.add_argument("--repeat", type=int, default=3, help="Starts per worker count, the median is reported")
+    parser.add_argument("--latency", type=float, default=0, help="DMART stub latency, in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="DMART stub jitter, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of DMART stub calls failed")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+    result = bench(args)
+    report(result)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
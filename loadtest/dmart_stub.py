@@ -0,0 +1,340 @@
+"""Local stand-in for DMART, seeded from the `spaces/` tree
+
+Speaks the endpoints `pydmart.DmartService` uses (/user/login, /{scope}/query,
+/managed/request, /managed/resource_with_payload and /managed/payload) against an
+in-memory store loaded from the space/folder/entry meta files, with optional latency,
+jitter and error injection on every call:
+
+    python -m loadtest.dmart_stub --port 8282 --latency 20 --jitter 10 --error-rate 0.01
+
+then point the middleware at it with DMART_BASE_URL=http://127.0.0.1:8282. Any
+username/password logs in unless --username/--password are given. Writes live in
+memory only and uploaded payloads in a temporary folder, the files under `spaces/` are
+never modified.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import shutil
+import tempfile
+import time
+import uuid
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, BinaryIO
+
+import jwt
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse
+from starlette.routing import Route
+
+from utils.regex import FILE_PATTERN, FOLDER_PATTERN, SPACES_PATTERN
+
+SPACES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "spaces")
+
+
+def normalize_subpath(subpath: str) -> str:
+    return "/" + subpath.strip("/")
+
+
+def failed(status_code: int, type: str, code: int, message: str, info: list | None = None) -> JSONResponse:
+    error: dict[str, Any] = {"type": type, "code": code, "message": message}
+    if info is not None:
+        error["info"] = info
+    return JSONResponse({"status": "failed", "error": error}, status_code=status_code)
+
+
+class Store:
+    """Entries by space, subpath and shortname in the shape DMART returns them in query records"""
+
+    def __init__(self):
+        self.entries: dict[str, dict[str, dict[str, dict[str, Any]]]] = {}
+
+    def add(self, space_name: str, subpath: str, shortname: str, resource_type: str, attributes: dict) -> dict:
+        record: dict[str, Any] = {
+            "resource_type": resource_type,
+            "shortname": shortname,
+            "subpath": normalize_subpath(subpath),
+            "attributes": {**attributes, "space_name": space_name},
+        }
+        self.entries.setdefault(space_name, {}).setdefault(record["subpath"], {})[shortname] = record
+        return record
+
+    def load(self, spaces_dir: str) -> None:
+        for root, _, files in os.walk(spaces_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                relative = "/" + os.path.relpath(path, spaces_dir).replace(os.sep, "/")
+                self.load_meta(spaces_dir, relative)
+
+    def load_meta(self, spaces_dir: str, relative: str) -> None:
+        """`relative` is a path under spaces_dir like /space/sub/path/.dm/shortname/meta.content.json"""
+        space_name, _, rest = relative.strip("/").partition("/")
+        if SPACES_PATTERN.search(relative) and rest == ".dm/meta.space.json":
+            self.add(space_name, "/", space_name, "space", self.read_meta(spaces_dir, relative))
+        elif match := FOLDER_PATTERN.search(relative):
+            folder = relative[: match.start()]
+            parent = folder.strip("/").partition("/")[2]
+            self.add(space_name, parent, match.group(1), "folder", self.read_meta(spaces_dir, relative, folder))
+        elif match := FILE_PATTERN.search(relative):
+            subpath = rest[: rest.index(".dm/")].strip("/")
+            folder = f"/{space_name}/{subpath}".rstrip("/")
+            self.add(space_name, subpath, match.group(1), match.group(2), self.read_meta(spaces_dir, relative, folder))
+
+    @staticmethod
+    def read_meta(spaces_dir: str, relative: str, payload_folder: str | None = None) -> dict:
+        with open(spaces_dir + relative) as file:
+            meta = json.load(file)
+        payload = meta.get("payload")
+        # JSON payloads sit next to the .dm folder, DMART returns them inline
+        if payload_folder and payload and payload.get("content_type") == "json" and isinstance(payload.get("body"), str):
+            body_path = f"{spaces_dir}{payload_folder}/{payload['body']}"
+            if os.path.isfile(body_path):
+                with open(body_path) as file:
+                    payload["body"] = json.load(file)
+        meta.pop("shortname", None)
+        return meta
+
+    def query(self, query: dict) -> tuple[list[dict], int]:
+        subpath = normalize_subpath(query.get("subpath", "/"))
+        folders = self.entries.get(query.get("space_name", ""), {})
+        if query.get("exact_subpath") or query.get("type") == "subpath":
+            candidates = list(folders.get(subpath, {}).values())
+        else:
+            candidates = [
+                record
+                for folder, records in folders.items()
+                if folder == subpath or subpath == "/" or folder.startswith(subpath + "/")
+                for record in records.values()
+            ]
+        shortnames = set(query.get("filter_shortnames") or [])
+        types = set(query.get("filter_types") or [])
+        search = query.get("search") or ""
+        matched = [
+            record
+            for record in candidates
+            if (not shortnames or record["shortname"] in shortnames)
+            and (not types or record["resource_type"] in types)
+            and (not search or search in json.dumps(record["attributes"]))
+        ]
+        offset = query.get("offset") or 0
+        limit = query.get("limit") or 10
+        page = matched[offset: offset + limit]
+        if not query.get("retrieve_json_payload"):
+            page = [without_body(record) for record in page]
+        return page, len(matched)
+
+    def apply(self, space_name: str, request_type: str, record: dict) -> dict:
+        folder = self.entries.setdefault(space_name, {}).setdefault(normalize_subpath(record["subpath"]), {})
+        shortname = record["shortname"]
+        if request_type == "create":
+            if shortname == "auto":
+                shortname = uuid.uuid4().hex[:8]
+            if shortname in folder:
+                raise KeyError(f"Entry {shortname} already exists")
+            now = datetime.now().isoformat()
+            attributes = {
+                "uuid": str(uuid.uuid4()), "created_at": now, "updated_at": now, "owner_shortname": "dmart",
+                **record.get("attributes", {}),
+            }
+            return self.add(space_name, record["subpath"], shortname, record["resource_type"], attributes)
+        if shortname not in folder:
+            raise KeyError(f"Entry {shortname} does not exist")
+        if request_type == "delete":
+            return folder.pop(shortname)
+        if request_type == "update":
+            existing = folder[shortname]
+            existing["attributes"] = {
+                **existing["attributes"], **record.get("attributes", {}), "updated_at": datetime.now().isoformat(),
+            }
+            return existing
+        raise ValueError(f"Request type {request_type} is not supported by the stub")
+
+
+def without_body(record: dict) -> dict:
+    payload = record["attributes"].get("payload")
+    if not isinstance(payload, dict) or "body" not in payload:
+        return record
+    return {**record, "attributes": {**record["attributes"], "payload": {**payload, "body": None}}}
+
+
+class Faults:
+    def __init__(self, latency: float = 0, jitter: float = 0, error_rate: float = 0):
+        self.latency = latency  # In milliseconds
+        self.jitter = jitter  # In milliseconds, uniform in [-jitter, +jitter] around latency
+        self.error_rate = error_rate  # Fraction of calls answered with a 500
+
+    async def inject(self) -> JSONResponse | None:
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            return failed(500, "stub", 500, "Injected failure")
+        return None
+
+
+def create_app(
+    spaces_dir: str = SPACES_DIR,
+    faults: Faults | None = None,
+    username: str = "",
+    password: str = "",
+    token_ttl: float = 86400,
+    ranges: bool = True,
+) -> Starlette:
+    store = Store()
+    store.load(spaces_dir)
+    faults = faults or Faults()
+    secret = secrets.token_hex(32)
+    payloads_dir = tempfile.mkdtemp(prefix="dmart-stub-")
+
+    def authorized(request: Request) -> bool:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer":
+            return False
+        try:
+            return float(jwt.decode(token, secret, algorithms=["HS256"])["expires"]) > time.time()
+        except (jwt.PyJWTError, KeyError, ValueError):
+            return False
+
+    async def login(request: Request) -> JSONResponse:
+        if error := await faults.inject():
+            return error
+        body = await request.json()
+        if username and (body.get("shortname") != username or body.get("password") != password):
+            return failed(401, "auth", 10, "Invalid username or password")
+        token = jwt.encode(
+            {"data": {"shortname": body.get("shortname", "")}, "expires": time.time() + token_ttl}, secret, algorithm="HS256"
+        )
+        return JSONResponse({
+            "status": "success",
+            "records": [{
+                "resource_type": "user",
+                "shortname": body.get("shortname", ""),
+                "subpath": "users",
+                "attributes": {"access_token": token, "type": "web"},
+            }],
+        })
+
+    async def query(request: Request) -> JSONResponse:
+        if error := await faults.inject():
+            return error
+        if request.path_params["scope"] != "public" and not authorized(request):
+            return failed(401, "jwtauth", 13, "Not authenticated")
+        records, total = store.query(await request.json())
+        return JSONResponse({
+            "status": "success",
+            "records": records,
+            "attributes": {"total": total, "returned": len(records)},
+        })
+
+    async def managed_request(request: Request) -> JSONResponse:
+        if error := await faults.inject():
+            return error
+        if not authorized(request):
+            return failed(401, "jwtauth", 13, "Not authenticated")
+        action = await request.json()
+        records, failures = [], []
+        for record in action.get("records", []):
+            try:
+                records.append(store.apply(action["space_name"], action["request_type"], record))
+            except (KeyError, ValueError) as e:
+                failures.append({"record": record, "error": str(e).strip("'"), "error_code": 400})
+        if failures:
+            return failed(
+                400, "request", 400, "Some records failed",
+                [{"successfull": [record["shortname"] for record in records], "failed": failures}],
+            )
+        return JSONResponse({"status": "success", "records": records})
+
+    def save_upload(source: BinaryIO, path: str) -> int:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        source.seek(0)
+        with open(path, "wb") as file:
+            shutil.copyfileobj(source, file, 1024 * 1024)
+            return file.tell()
+
+    def payload_path(space_name: str, subpath: str, file_name: str) -> str:
+        return os.path.join(payloads_dir, space_name, normalize_subpath(subpath).strip("/"), file_name)
+
+    async def resource_with_payload(request: Request) -> JSONResponse:
+        if error := await faults.inject():
+            return error
+        if not authorized(request):
+            return failed(401, "jwtauth", 13, "Not authenticated")
+        async with request.form(max_part_size=10 * 1024 * 1024) as form:
+            request_record = form["request_record"]
+            record = json.loads(request_record if isinstance(request_record, str) else await request_record.read())
+            upload = form["payload_file"]
+            if isinstance(upload, str) or not upload.filename:
+                return failed(400, "request", 400, "payload_file must be a file")
+            ext = os.path.splitext(upload.filename)[1]
+            path = payload_path(str(form["space_name"]), record["subpath"], f"{record['shortname']}{ext}")
+            # The upload is already spooled to a temporary file, copied off the event loop
+            size = await asyncio.to_thread(save_upload, upload.file, path)
+        record["attributes"]["payload"] = {**record["attributes"].get("payload", {}), "body": os.path.basename(path), "bytesize": size}
+        try:
+            return JSONResponse({"status": "success", "records": [store.apply(str(form["space_name"]), "create", record)]})
+        except (KeyError, ValueError) as e:
+            return failed(400, "request", 400, str(e).strip("'"))
+
+    async def payload(request: Request) -> FileResponse | JSONResponse:
+        if error := await faults.inject():
+            return error
+        if not authorized(request):
+            return failed(401, "jwtauth", 13, "Not authenticated")
+        subpath, _, file_name = request.path_params["path"].rpartition("/")
+        path = payload_path(request.path_params["space_name"], subpath, file_name)
+        if not os.path.isfile(path):
+            return failed(404, "media", 220, "Payload not found")
+        if not ranges:
+            # Like a server without Range support, the whole file every time
+            request.scope["headers"] = [(k, v) for k, v in request.scope["headers"] if k not in (b"range", b"if-range")]
+        return FileResponse(path)
+
+    @asynccontextmanager
+    async def lifespan(_: Starlette) -> AsyncIterator[None]:
+        yield
+        shutil.rmtree(payloads_dir, ignore_errors=True)
+
+    return Starlette(
+        routes=[
+            Route("/user/login", login, methods=["POST"]),
+            Route("/managed/request", managed_request, methods=["POST"]),
+            Route("/managed/resource_with_payload", resource_with_payload, methods=["POST"]),
+            Route("/managed/payload/{resource_type}/{space_name}/{path:path}", payload, methods=["GET"]),
+            Route("/{scope}/query", query, methods=["POST"]),
+        ],
+        lifespan=lifespan,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(__doc__ or "").partition("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8282)
+    parser.add_argument("--spaces", default=SPACES_DIR, help="Folder holding the spaces to seed from")
+    parser.add_argument("--latency", type=float, default=0, help="Added to every call, in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="Random +/- spread around the latency, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of calls failed with a 500")
+    parser.add_argument("--username", default="", help="Only accept this user, any user logs in when empty")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--token-ttl", type=float, default=86400, help="Lifetime of the issued access tokens, in seconds")
+    parser.add_argument("--no-ranges", action="store_true", help="Ignore Range headers, payloads are always sent whole")
+    args = parser.parse_args()
+
+    config = Config()
+    config.bind = [f"{args.host}:{args.port}"]
+    config.accesslog = None
+    app = create_app(args.spaces, Faults(args.latency, args.jitter, args.error_rate), args.username, args.password, args.token_ttl, not args.no_ranges)
+    asyncio.run(serve(app, config))  # type: ignore
+
+
+if __name__ == "__main__":
+    main()
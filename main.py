@@ -3,7 +3,9 @@
 from starlette.datastructures import UploadFile
 from contextlib import asynccontextmanager
 import asyncio
-import json
+import logging
+import random
+import re
 from os import getpid
 import sys
 import time
@@ -14,22 +16,40 @@ from urllib.parse import urlparse, quote
 from jsonschema.exceptions import ValidationError as SchemaValidationError
 from pydantic import ValidationError
 
+from utils.attachments import RangeNotSatisfiable
+from utils.compression import CompressionMiddleware
 from utils.dmart import dmart
 from utils.git_info import git_info
-from utils.middleware import CustomRequestMiddleware, ChannelMiddleware
+from utils.middleware import (
+    ChannelIndex, set_correlation_id, set_request_data, reset_request_data, set_deadline, reset_deadline
+)
 from utils.jwt import JWTBearer
-from fastapi import Depends, FastAPI, Request, Response, status
+from utils.rate_limit import RateLimiter, RateLimitExceeded, SharedBuckets
+from utils.schemas import schema_registry
+from utils.password_hashing import hashing
+from utils.metrics import (
+    http_request_duration,
+    http_request_timeouts,
+    http_requests,
+    http_requests_in_flight,
+    monitor_event_loop,
+    registry,
+)
+from fastapi import Depends, FastAPI, Request, Response, params, status
 from utils.logger import logging_schema
 from fastapi.logger import logger
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
-from starlette.concurrency import iterate_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import PlainTextResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from utils.settings import settings
-from asgi_correlation_id import CorrelationIdMiddleware
+from utils import fast_json
+from utils.fast_json import FastJSONResponse
+from asgi_correlation_id.context import correlation_id
 from utils.internal_error_code import InternalErrorCode
 import json_logging
 from api.dummy.router import router as dummy_router
@@ -42,6 +62,7 @@ async def lifespan(app: FastAPI):
     logger.info("Starting up")
     print('{"stage":"starting up"}')
 
+    await dmart.connect()
     try:
         r = await dmart.login(settings.dmart_username, settings.dmart_password)
         if r.status == Status.failed:
@@ -49,17 +70,24 @@ async def lifespan(app: FastAPI):
     except Exception:
         sys.exit("Failed to connect to DMART")
 
-    openapi_schema = app.openapi()
-    paths = openapi_schema["paths"]
-    for path in paths:
-        for method in paths[path]:
-            responses = paths[path][method]["responses"]
-            if responses.get("422"):
-                responses.pop("422")
-    app.openapi_schema = openapi_schema
+    if settings.schemas_source == "folder":
+        await asyncio.to_thread(schema_registry.load_folder, settings.spaces_folder)
+    elif settings.schemas_source == "dmart":
+        await schema_registry.load_dmart(dmart.query, settings.schema_spaces)
+
+    await asyncio.to_thread(registry.prune)
+    background = [asyncio.create_task(registry.publish_forever())]
+    if settings.metrics_loop_lag_interval > 0:
+        background.append(asyncio.create_task(monitor_event_loop(settings.metrics_loop_lag_interval)))
 
     yield
 
+    for task in background:
+        task.cancel()
+    registry.publish()
+    hashing.close()
+    await dmart.close()
+
     logger.info("Application shutting down")
     print('{"stage":"shutting down"}')
 
@@ -88,38 +116,116 @@ app = FastAPI(
 )
 
 
+def openapi() -> dict[str, Any]:
+    """Built on the first call to /openapi.json or /docs rather than at startup in every worker"""
+    if app.openapi_schema:
+        return app.openapi_schema
+    openapi_schema = FastAPI.openapi(app)
+    paths = openapi_schema["paths"]
+    for path in paths:
+        for method in paths[path]:
+            responses = paths[path][method]["responses"]
+            if responses.get("422"):
+                responses.pop("422")
+    app.openapi_schema = openapi_schema
+    return openapi_schema
+
+
+app.openapi = openapi  # type: ignore[method-assign]
+
+
+def json_prefix(value: Any, budget: int) -> tuple[Any, int]:
+    """The start of `value` that serializes in about `budget` bytes, and what is left of the budget
+
+    Containers keep their first items and strings are cut, a negative remainder means
+    something was left out.
+    """
+    if isinstance(value, dict):
+        budget -= 2
+        prefix = {}
+        for key, item in value.items():
+            if budget < 0:
+                break
+            prefix[key], budget = json_prefix(item, budget - len(str(key)) - 4)
+        return prefix, budget
+    if isinstance(value, list):
+        budget -= 2
+        items = []
+        for item in value:
+            if budget < 0:
+                break
+            item, budget = json_prefix(item, budget - 1)
+            items.append(item)
+        return items, budget
+    if isinstance(value, str):
+        return value[:max(0, budget)], budget - len(value) - 2
+    return value, budget - len(str(value))
+
+
+def log_bounded(value: Any) -> Any:
+    """`value` (masked) if it serializes within request_log_max_bytes, else its truncated serialization
+
+    Only the part of a large body that fits in the log is masked and serialized. Values JSON
+    cannot encode are logged as their truncated repr, logging never fails the request.
+    """
+    limit = settings.request_log_max_bytes
+    prefix, left = json_prefix(value, limit)
+    masked = mask_sensitive_data(prefix)
+    try:
+        raw = fast_json.dumps(masked)
+    except (TypeError, ValueError):
+        return repr(masked)[:limit]
+    if left >= 0 and len(raw) <= limit:
+        return masked
+    return raw[:limit].decode("utf8", errors="replace")
+
+
 async def capture_body(request: Request):
-    request.state.request_body = {}
+    """Keeps the request body for the access log, from what FastAPI already parsed for the route
 
-    if (
-            request.method == "POST"
-            and "application/json" in request.headers.get("content-type", "")
-    ):
-        request.state.request_body = await request.json()
-
-    if (
-            request.method == "POST"
-            and request.headers.get("content-type")
-            and "multipart/form-data" in request.headers.get("content-type", [])
-    ):
+    The JSON and form data are cached on the request, so this adds no parsing of its own.
+    Bodies the route does not read are only described, forms are never parsed and uploads
+    never read just to log them.
+    """
+    request.state.request_body = {}
+    content_type = request.headers.get("content-type", "")
+    if not content_type:
+        return
+    body_field = getattr(request.scope.get("route"), "body_field", None)
+    summary = {"content_type": content_type, "size": request.headers.get("content-length")}
+
+    if "multipart/form-data" in content_type or "application/x-www-form-urlencoded" in content_type:
+        if body_field is None or not isinstance(body_field.field_info, params.Form):
+            request.state.request_body = summary
+            return
         form = await request.form()
-        for field in form:
-            one = form[field]
+        for field, one in form.multi_items():
             if isinstance(one, str):
-                request.state.request_body[field] = form.get(field)
+                request.state.request_body[field] = one
             elif isinstance(one, UploadFile):
                 request.state.request_body[field] = {
                     "name": one.filename,
                     "content_type": one.content_type,
+                    "size": one.size,
                 }
+        request.state.request_body = log_bounded(request.state.request_body)
+    elif "json" in content_type:
+        declared = int(request.headers.get("content-length") or 0)
+        if body_field is None and (not declared or declared > settings.request_log_max_bytes):
+            request.state.request_body = summary
+            return
+        try:
+            request.state.request_body = log_bounded(await request.json())
+        except ValueError:
+            request.state.request_body = summary
 
 
 @app.exception_handler(StarletteHTTPException)
 async def my_exception_handler(_, exception):
-    return JSONResponse(
+    return FastJSONResponse(
         content=exception.detail,
         status_code=exception.status_code,
-        headers={"correlation_id": json_logging.get_correlation_id()},
+        headers={"correlation_id": correlation_id.get() or ""},
     )
 
 
@@ -134,11 +240,7 @@ async def validation_exception_handler(_: Request, exc: RequestValidationError):
     )
 
 
-app.add_middleware(CustomRequestMiddleware)
-app.add_middleware(ChannelMiddleware)
-
-
-def set_middleware_extra(request, response, start_time, user_shortname, exception_data, response_body):
+def set_middleware_extra(request, status_code, response_headers, start_time, user_shortname, exception_data, response_body):
     extra = {
         "props": {
             "timestamp": start_time,
@@ -146,83 +248,126 @@ def set_middleware_extra(request, response, start_time, user_shortname, exceptio
             "server": settings.servername,
             "process_id": getpid(),
             "user_shortname": user_shortname,
+            # Only the parts carrying client or upstream data are masked
             "request": {
-                "url": request.url._url,
+                "url": mask_sensitive_data(request.url._url),
                 "verb": request.method,
                 "path": quote(str(request.url.path)),
-                "query_params": dict(request.query_params.items()),
-                "headers": dict(request.headers.items()),
+                "query_params": mask_sensitive_data(dict(request.query_params.items())),
+                "headers": mask_sensitive_data(dict(request.headers.items())),
             },
             "response": {
-                "headers": dict(response.headers.items()),
-                "http_status": response.status_code,
+                "headers": mask_sensitive_data(dict(response_headers.items())),
+                "http_status": status_code,
             },
         }
     }
 
     if exception_data is not None:
-        extra["props"]["exception"] = exception_data
+        extra["props"]["exception"] = mask_sensitive_data(exception_data)
     if (hasattr(request.state, "request_body") and isinstance(extra, dict) and isinstance(extra["props"], dict)
             and isinstance(extra["props"]["request"], dict)):
-        extra["props"]["request"]["body"] = request.state.request_body
+        extra["props"]["request"]["body"] = mask_sensitive_data(request.state.request_body)
     if (response_body and isinstance(extra, dict) and isinstance(extra["props"], dict)
             and isinstance(extra["props"]["response"], dict)):
-        extra["props"]["response"]["body"] = response_body
+        extra["props"]["response"]["body"] = mask_sensitive_data(response_body)
 
     return extra
 
 
-def set_middleware_response_headers(request, response):
-    referer = request.headers.get(
+def set_middleware_response_headers(request_headers: Headers, response_headers: MutableHeaders) -> None:
+    referer = request_headers.get(
         "referer",
-        request.headers.get("origin",
-                            request.headers.get("x-forwarded-proto", "http")
+        request_headers.get("origin",
+                            request_headers.get("x-forwarded-proto", "http")
                             + "://"
-                            + request.headers.get(
+                            + request_headers.get(
                                 "x-forwarded-host", f"{settings.listening_host}:{settings.listening_port}"
                             )),
     )
     origin = urlparse(referer)
-    response.headers[
-        "Access-Control-Allow-Origin"
-    ] = f"{origin.scheme}://{origin.netloc}"
+    response_headers["Access-Control-Allow-Origin"] = f"{origin.scheme}://{origin.netloc}"
+
+    # if "localhost" in response_headers["Access-Control-Allow-Origin"]:
+    #     response_headers["Access-Control-Allow-Origin"] = "*"
+
+    response_headers["Access-Control-Allow-Credentials"] = "true"
+    response_headers["Access-Control-Allow-Headers"] = "content-type, charset, authorization, accept-language, content-length"
+    response_headers["Access-Control-Max-Age"] = "600"
+    response_headers["Access-Control-Allow-Methods"] = "OPTIONS, DELETE, POST, GET, PATCH, PUT"
 
-    # if "localhost" in response.headers["Access-Control-Allow-Origin"]:
-    #     response.headers["Access-Control-Allow-Origin"] = "*"
+    response_headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response_headers["Pragma"] = "no-cache"
+    response_headers["Expires"] = "0"
+    response_headers["x-server-time"] = datetime.now().isoformat()
+    response_headers["Access-Control-Expose-Headers"] = "x-server-time"
 
-    response.headers["Access-Control-Allow-Credentials"] = "true"
-    response.headers["Access-Control-Allow-Headers"] = "content-type, charset, authorization, accept-language, content-length"
-    response.headers["Access-Control-Max-Age"] = "600"
-    response.headers[
-        "Access-Control-Allow-Methods"
-    ] = "OPTIONS, DELETE, POST, GET, PATCH, PUT"
 
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
-    response.headers["x-server-time"] = datetime.now().isoformat()
-    response.headers["Access-Control-Expose-Headers"] = "x-server-time"
-    return response
+sensitive_keys = frozenset(settings.log_masked_keys)
 
 
 def mask_sensitive_data(data):
+    """Masked version of data, subtrees without anything to mask are returned as is (not copied)"""
     if isinstance(data, dict):
-        return {k: mask_sensitive_data(v) if k not in ['password', 'access_token', 'refresh_token', 'auth_token'] else '******' for k, v in data.items()}
+        masked = None
+        for k, v in data.items():
+            new = '******' if k in sensitive_keys else mask_sensitive_data(v)
+            if new is not v:
+                if masked is None:
+                    masked = dict(data)
+                masked[k] = new
+        return data if masked is None else masked
     elif isinstance(data, list):
-        return [mask_sensitive_data(item) for item in data]
+        items = [mask_sensitive_data(item) for item in data]
+        return data if all(new is old for new, old in zip(items, data)) else items
     elif isinstance(data, str) and 'auth_token' in data:
         return '******'
     return data
 
 
-def set_logging(response, extra, request, exception_data):
-    extra = mask_sensitive_data(extra)
-    if 400 <= response.status_code < 500:
-        logger.warning("Served request", extra=extra) # type: ignore
-    elif response.status_code >= 500 or exception_data is not None:
-        logger.error("Served request", extra=extra) # type: ignore
-    elif request.method != "OPTIONS":  # Do not log OPTIONS request, to reduce excessive logging
-        logger.info("Served request", extra=extra) # type: ignore
+def is_sampled(status_code: int) -> bool:
+    rate = settings.log_sample_rates.get(f"{status_code // 100}xx", 1.0)
+    return rate >= 1 or random.random() < rate
+
+
+def get_log_level(status_code: int, method: str, exception_data) -> int | None:
+    if 400 <= status_code < 500:
+        return logging.WARNING
+    elif status_code >= 500 or exception_data is not None:
+        return logging.ERROR
+    elif method != "OPTIONS":  # Do not log OPTIONS request, to reduce excessive logging
+        return logging.INFO
+    return None
+
+
+def set_logging(level: int, extra):
+    logger.log(level, "Served request", extra=extra)
+
+
+response_log_routes = [(re.compile(pattern), limit) for pattern, limit in settings.response_log_routes.items()]
+
+
+def get_response_log_limit(path: str, content_type: str) -> int:
+    """Max response bytes kept for logging, 0 means the body is not captured"""
+    for pattern, limit in response_log_routes:
+        if pattern.search(path):
+            return limit
+    for prefix, limit in settings.response_log_content_types.items():
+        if content_type.startswith(prefix):
+            return limit
+    return settings.response_log_max_bytes
+
+
+def decode_response_body(raw_data: bytes, truncated: bool) -> str | dict:
+    if not raw_data:
+        return {}
+    if truncated:
+        return raw_data.decode("utf8", errors="replace")
+    try:
+        body: str | dict = fast_json.loads(raw_data)
+    except Exception:
+        body = {}
+    return body
 
 
 def set_stack(e):
@@ -236,131 +381,220 @@ def set_stack(e):
         if "site-packages" not in frame.f_code.co_filename
     ]
 
-@app.middleware("http")
-async def middle(request: Request, call_next):
-    """Wrapper function to manage errors and logging"""
-    if request.url._url.endswith("/docs") or request.url._url.endswith("openapi.json"):
-        return await call_next(request)
+def set_error_response(e: Exception) -> tuple[FastJSONResponse, dict, dict[str, Any] | None]:
+    """Map an exception raised while serving a request to its error response
 
-    start_time = time.time()
-    response_body: str | dict = {}
+    The body is built once as a dict, it is both rendered into the response and logged as is.
+    """
     exception_data: dict[str, Any] | None = None
-
-    try:
-        response = await asyncio.wait_for(call_next(request), timeout=settings.request_timeout)
-        response.headers["correlation_id"] = json_logging.get_correlation_id()
-        raw_response = [section async for section in response.body_iterator]
-        response.body_iterator = iterate_in_threadpool(iter(raw_response))
-        raw_data = b"".join(raw_response)
-        if raw_data:
-            try:
-                response_body = json.loads(raw_data)
-            except Exception:
-                response_body = {}
-    except asyncio.TimeoutError:
-        response = JSONResponse(content={'status':'failed',
-            'error': {"code":504, "message": 'Request processing time exceeded limit'}},
-            status_code=status.HTTP_504_GATEWAY_TIMEOUT)
-        response_body = json.loads(str(response.body, 'utf8'))
-    except DmartException as e:
-        response = JSONResponse(
-            headers={
-                "correlation_id": json_logging.get_correlation_id(),
-            },
-            status_code=e.status_code,
-            content=jsonable_encoder(
-                ApiResponse(status=DmartStatus.failed, error=e.error, records=[])
-            ),
-        )
+    headers = {"correlation_id": correlation_id.get() or ""}
+    if isinstance(e, TimeoutError):
+        status_code = status.HTTP_504_GATEWAY_TIMEOUT
+        response_body: dict = {'status':'failed',
+            'error': {"code":504, "message": 'Request processing time exceeded limit'}}
+    elif isinstance(e, DmartException):
         stack = set_stack(e)
         exception_data = {"props": {"exception": str(e), "stack": stack}}
-        response_body = json.loads(str(response.body, 'utf8'))
-    except ValidationError as e:
+        status_code = e.status_code
+        response_body = ApiResponse(status=DmartStatus.failed, error=e.error, records=[]).model_dump(mode="json")
+        if isinstance(e, RateLimitExceeded):
+            headers["Retry-After"] = str(e.retry_after)
+        elif isinstance(e, RangeNotSatisfiable):
+            headers["Content-Range"] = e.content_range
+    elif isinstance(e, ValidationError):
         stack = set_stack(e)
         exception_data = {"props": {"exception": str(e), "stack": stack}}
-        response = JSONResponse(
-            headers={
-                "correlation_id": json_logging.get_correlation_id(),
-            },
-            status_code=422,
-            content={
-                "status": "failed",
-                "error": {
-                    "type": "validation",
-                    "code": 422,
-                    "message": "Validation error [2]",
-                    "info": jsonable_encoder(e.errors()),
-                },
+        status_code = 422
+        response_body = {
+            "status": "failed",
+            "error": {
+                "type": "validation",
+                "code": 422,
+                "message": "Validation error [2]",
+                "info": jsonable_encoder(e.errors()),
             },
-        )
-        response_body = json.loads(str(response.body, 'utf8'))
-    except SchemaValidationError as e:
+        }
+    elif isinstance(e, SchemaValidationError):
         stack = set_stack(e)
         exception_data = {"props": {"exception": str(e), "stack": stack}}
-        response = JSONResponse(
-            headers={
-                "correlation_id": json_logging.get_correlation_id(),
-            },
-            status_code=400,
-            content={
-                "status": "failed",
-                "error": {
-                    "type": "validation",
-                    "code": 422,
-                    "message": "Validation error [3]",
-                    "info": [{
-                        "loc": list(e.path),
-                        "msg": e.message
-                    }],
-                },
+        status_code = 400
+        response_body = {
+            "status": "failed",
+            "error": {
+                "type": "validation",
+                "code": 422,
+                "message": "Validation error [3]",
+                "info": [{
+                    "loc": list(e.path),
+                    "msg": e.message
+                }],
             },
-        )
-        response_body = json.loads(str(response.body, 'utf8'))
-    except Exception as _:
-        exception_message = ""
-        stack = None
-        if ee := sys.exc_info()[1]:
-            stack = set_stack(ee)
-            exception_message = str(ee)
-            exception_data = {"props": {"exception": str(ee), "stack": stack}}
+        }
+    else:
+        stack = set_stack(e)
+        exception_message = str(e)
+        exception_data = {"props": {"exception": str(e), "stack": stack}}
 
         error_log = {"type": "general", "code": 99, "message": exception_message}
         if settings.debug_enabled:
             error_log["stack"] = stack
-        response = JSONResponse(
-            headers={
-                "correlation_id": json_logging.get_correlation_id(),
-            },
-            status_code=500,
-            content={
-                "status": "failed",
-                "error": error_log,
-            },
-        )
-        response_body = json.loads(str(response.body, 'utf8'))
+        status_code = 500
+        response_body = {
+            "status": "failed",
+            "error": error_log,
+        }
 
+    response = FastJSONResponse(
+        headers=headers,
+        status_code=status_code,
+        content=response_body,
+    )
+    return response, response_body, exception_data
 
-    response = set_middleware_response_headers(request, response)
 
-    user_shortname = "guest"
-    try:
-        user_shortname = str(await JWTBearer().__call__(request))
-    except Exception:
-        pass
+def record_request(scope: Scope, status_code: int, duration: float) -> None:
+    # The route template keeps the label set bounded, requests rejected before routing share one label.
+    # Routes of included routers keep their own path, FastAPI records the prefixed one next to them.
+    included = scope.get("fastapi", {}).get("effective_route_context")
+    route = str(getattr(included, "path", None) or getattr(scope.get("route"), "path", "unmatched"))
+    http_requests.inc(scope["method"], route, str(status_code))
+    http_request_duration.observe(duration, scope["method"], route)
 
-    extra = set_middleware_extra(request, response, start_time, user_shortname, exception_data, response_body)
 
-    set_logging(response, extra, request, exception_data)
+class ResponseCapture:
+    """What the access log needs from the response: status, headers and a bounded body prefix"""
 
-    return response
+    def __init__(self) -> None:
+        self.status_code = 0
+        self.sampled = True
+        self.headers: MutableHeaders | None = None
+        self.limit = 0
+        self.body = bytearray()
+        self.size = 0
 
+    def add(self, chunk: bytes) -> None:
+        if len(self.body) < self.limit:
+            self.body += chunk[:self.limit - len(self.body)]
+        self.size += len(chunk)
 
-app.add_middleware(
-    CorrelationIdMiddleware,
-    header_name='X-Correlation-ID',
-    update_request_header=False,
-    validator=None,
-)
+
+class RequestMiddleware:
+    """Correlation id, channel auth, request context, timeout, error mapping and access logging in one pass"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.channels = ChannelIndex(settings.channels)
+        self.rate_limiter = RateLimiter(
+            settings.channels,
+            settings.user_rate_limit,
+            SharedBuckets(settings.rate_limit_file, settings.rate_limit_slots),
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] not in ["http", "websocket"]:
+            await self.app(scope, receive, send)
+            return
+
+        cid = set_correlation_id(scope)
+        request_data = set_request_data(scope)
+        try:
+            if scope["type"] == "http" and not scope["path"].endswith(("/docs", "openapi.json")):
+                await self.serve(scope, receive, send, cid)
+            else:
+                self.channels.check(scope)
+                await self.app(scope, receive, send)
+        finally:
+            reset_request_data(request_data)
+
+    async def serve(self, scope: Scope, receive: Receive, send: Send, cid: str) -> None:
+        start_time = time.time()
+        request = Request(scope, receive)
+        capture = ResponseCapture()
+        response_body: str | dict | None = None
+        exception_data: dict[str, Any] | None = None
+        deadline: asyncio.Timeout | None = None
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                if deadline is not None:
+                    # The timeout covers producing the response, not streaming it
+                    deadline.reschedule(None)
+                headers = MutableHeaders(scope=message)
+                headers["correlation_id"] = cid
+                headers.append("X-Correlation-ID", cid)
+                set_middleware_response_headers(request.headers, headers)
+                capture.status_code = message["status"]
+                capture.headers = headers
+                capture.sampled = is_sampled(capture.status_code)
+                level = get_log_level(capture.status_code, request.method, None)
+                if response_body is None and capture.sampled and level is not None and logger.isEnabledFor(level):
+                    capture.limit = get_response_log_limit(scope["path"], headers.get("content-type", ""))
+            elif message["type"] == "http.response.body":
+                capture.add(message.get("body", b""))
+            await send(message)
+
+        http_requests_in_flight.inc()
+        try:
+            async with asyncio.timeout(settings.request_timeout) as deadline:
+                deadline_token = set_deadline(deadline)
+                try:
+                    self.channels.check(scope)
+                    await self.check_rate_limits(request)
+                    await self.app(scope, receive, send_wrapper)
+                finally:
+                    reset_deadline(deadline_token)
+        except Exception as e:
+            if deadline is not None and deadline.expired():
+                http_request_timeouts.inc()
+            deadline = None
+            if capture.status_code:
+                # Too late for an error response, log what was sent and let the server close it
+                exception_data = {"props": {"exception": str(e), "stack": set_stack(e)}}
+                raise
+            response, response_body, exception_data = set_error_response(e)
+            await response(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec()
+            record_request(scope, capture.status_code or 500, time.time() - start_time)
+            await self.log(request, capture, start_time, response_body, exception_data)
+
+    async def check_rate_limits(self, request: Request) -> None:
+        user_shortname = None
+        if self.rate_limiter.limits_users:
+            try:
+                # The outcome is kept on the request, the route's own JWTBearer does not decode again
+                user_shortname = (await JWTBearer().__call__(request))[0]
+            except DmartException:
+                pass
+        await self.rate_limiter.check(request.headers.get("x-channel-key"), user_shortname)
+
+    @staticmethod
+    async def log(request: Request, capture: ResponseCapture, start_time: float, response_body, exception_data) -> None:
+        level = get_log_level(capture.status_code or 500, request.method, exception_data)
+        if level is None or not logger.isEnabledFor(level):
+            return
+        # Requests that failed with an exception are always logged
+        if exception_data is None and not capture.sampled:
+            return
+
+        user_shortname = "guest"
+        try:
+            # Reuses the result the route stored on request.state, only decodes for routes without auth
+            user_shortname = (await JWTBearer().__call__(request))[0]
+        except Exception:
+            pass
+
+        if response_body is None:
+            response_body = decode_response_body(bytes(capture.body), capture.size > len(capture.body))
+        extra = set_middleware_extra(
+            request, capture.status_code, capture.headers or {}, start_time, user_shortname, exception_data, response_body
+        )
+        set_logging(level, extra)
+
+
+app.add_middleware(RequestMiddleware)
+# Outermost, the access log sees the responses before they are compressed
+app.add_middleware(CompressionMiddleware)
 
 
 @app.get("/", include_in_schema=False)
@@ -368,6 +602,13 @@ async def root():
     return {"status": "success", "message": "DMART Microservice API"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(
+        await asyncio.to_thread(registry.render, registry.snapshot()), media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.get("/spaces-backup", include_in_schema=False)
 async def space_backup(key: str):
     if not key or key != "ABC":
@@ -415,8 +656,6 @@ async def catchall() -> None:
     )
 
 
-json_logging.init_request_instrument(app)
-
 async def main():
     config = Config()
     config.bind = [f"{settings.listening_host}:{settings.listening_port}"]
@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from utils import regex
 
 
 class DummyData(BaseModel):
@@ -7,3 +9,7 @@ class DummyData(BaseModel):
     mere_float: float
     mere_bool: bool
     mere_dict: dict
+
+
+class DummyBatchItem(DummyData):
+    shortname: str = Field(pattern=regex.SHORTNAME)
@@ -0,0 +1,136 @@
+import re
+from collections.abc import AsyncIterator
+
+import aiohttp
+from fastapi import status
+from pydmart.enums import ContentType, ResourceType
+from pydmart.models import DmartException
+from pydmart.models import Error as DmartError
+from starlette.responses import StreamingResponse
+
+from utils.internal_error_code import InternalErrorCode
+
+# DMART resource and content type of the attachments, by the extensions regex.FILENAME accepts
+ATTACHMENT_TYPES: dict[str, tuple[ResourceType, ContentType | None]] = {
+    "gif": (ResourceType.media, ContentType.image),
+    "png": (ResourceType.media, ContentType.image),
+    "jpeg": (ResourceType.media, ContentType.image),
+    "jpg": (ResourceType.media, ContentType.image),
+    "svg": (ResourceType.media, ContentType.image),
+    "wsq": (ResourceType.media, ContentType.image),
+    "pdf": (ResourceType.media, ContentType.pdf),
+    "mp3": (ResourceType.media, ContentType.audio),
+    "mp4": (ResourceType.media, ContentType.video),
+    "csv": (ResourceType.csv, ContentType.csv),
+    "jsonl": (ResourceType.jsonl, ContentType.jsonl),
+    "parquet": (ResourceType.parquet, ContentType.parquet),
+    "sqlite": (ResourceType.sqlite, ContentType.sqlite),
+    "sqlite3": (ResourceType.sqlite, ContentType.sqlite),
+    "db": (ResourceType.sqlite, ContentType.sqlite),
+    "duckdb": (ResourceType.media, None),
+}
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+RELAYED_HEADERS = (
+    "content-type", "content-length", "content-range", "accept-ranges", "etag", "last-modified", "content-disposition",
+)
+
+
+def too_large(limit: int) -> DmartException:
+    return DmartException(
+        status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        DmartError(type="attachment", code=InternalErrorCode.FILE_TOO_LARGE, message=f"Attachments are limited to {limit} bytes"),
+    )
+
+
+class RangeNotSatisfiable(DmartException):
+    def __init__(self, size: int | None):
+        super().__init__(
+            status.HTTP_416_RANGE_NOT_SATISFIABLE,
+            DmartError(type="attachment", code=InternalErrorCode.RANGE_NOT_SATISFIABLE, message="Requested range is not satisfiable"),
+        )
+        self.content_range = f"bytes */{size if size is not None else '*'}"
+
+
+def parse_range(header: str, size: int | None) -> tuple[int, int] | None:
+    """First and last byte of a single `bytes=` range, None for anything to be answered with the whole file
+
+    Multiple ranges are answered with the whole file, which RFC 9110 allows.
+    """
+    match = RANGE.match(header.strip())
+    if match is None or (not match.group(1) and not match.group(2)):
+        return None
+    first, last = match.group(1), match.group(2)
+    if not first:
+        # Suffix range: the last N bytes
+        if size is None:
+            return None
+        if int(last) == 0:
+            raise RangeNotSatisfiable(size)
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = int(last) if last else (size - 1 if size is not None else None)
+    if end is None:
+        return None
+    if size is not None:
+        if start >= size:
+            raise RangeNotSatisfiable(size)
+        end = min(end, size - 1)
+    if end < start:
+        raise RangeNotSatisfiable(size)
+    return start, end
+
+
+async def limited(body: AsyncIterator[bytes], limit: int) -> AsyncIterator[bytes]:
+    """Passes `body` on, failing with a 413 as soon as it goes over `limit` bytes"""
+    received = 0
+    async for chunk in body:
+        received += len(chunk)
+        if received > limit:
+            raise too_large(limit)
+        if chunk:
+            yield chunk
+
+
+async def relay(response: aiohttp.ClientResponse, chunk_size: int, skip: int = 0, length: int | None = None) -> AsyncIterator[bytes]:
+    """The upstream body in chunks of at most `chunk_size`, from byte `skip` on and `length` bytes long"""
+    try:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if skip:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk, skip = chunk[skip:], 0
+            if length is not None:
+                chunk = chunk[:length]
+                length -= len(chunk)
+            yield chunk
+            if length == 0:
+                return
+    finally:
+        response.release()
+
+
+def proxy_response(response: aiohttp.ClientResponse, chunk_size: int, range_header: str | None, if_range: str | None) -> StreamingResponse:
+    """Streams an upstream payload response, applying the client's Range itself when upstream ignored it"""
+    headers = {name: response.headers[name] for name in RELAYED_HEADERS if name in response.headers}
+    headers.setdefault("accept-ranges", "bytes")
+    media_type = headers.pop("content-type", "application/octet-stream")
+    size = int(headers["content-length"]) if "content-length" in headers else None
+    validator = response.headers.get("etag") or response.headers.get("last-modified")
+    if response.status != status.HTTP_200_OK or not range_header or (if_range and if_range != validator):
+        return StreamingResponse(relay(response, chunk_size), response.status, headers, media_type)
+
+    try:
+        byte_range = parse_range(range_header, size)
+    except DmartException:
+        response.release()
+        raise
+    if byte_range is None:
+        return StreamingResponse(relay(response, chunk_size), response.status, headers, media_type)
+    start, end = byte_range
+    headers["content-length"] = str(end - start + 1)
+    headers["content-range"] = f"bytes {start}-{end}/{size if size is not None else '*'}"
+    return StreamingResponse(
+        relay(response, chunk_size, start, end - start + 1), status.HTTP_206_PARTIAL_CONTENT, headers, media_type
+    )
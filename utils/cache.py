@@ -0,0 +1,214 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from time import monotonic
+from typing import Any
+
+from pydmart.models import ApiResponse, QueryRequest
+
+from utils import fast_json
+from utils.metrics import registry
+from utils.settings import settings
+
+GENERATION = struct.Struct("<Q")
+
+
+class CacheBackend(ABC):
+    """Storage used by QueryCache, subclass it to keep the entries somewhere else"""
+
+    @abstractmethod
+    def get(self, key: str) -> Any | None: ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float) -> None: ...
+
+    @abstractmethod
+    def delete(self, key: str) -> None: ...
+
+    def stats(self) -> dict[str, int]:
+        return {}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """LRU bounded to `max_entries`, with a per entry TTL"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key: str) -> Any | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= monotonic():
+            self.delete(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        if self.max_entries <= 0 or ttl <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (monotonic() + ttl, value)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        self.entries.pop(key, None)
+
+    def stats(self) -> dict[str, int]:
+        return {"entries": len(self.entries), "evictions": self.evictions}
+
+
+class SharedGenerations:
+    """Write counters in a memory mapped file, seen by every worker process of the host
+
+    There is one counter per hashed space/subpath. A cached response remembers the counter of
+    its subpath when it was fetched and is stale as soon as that counter moved, whichever
+    worker made the write. Subpaths sharing a counter only invalidate each other more often.
+    An empty `path` keeps the counters in this process.
+    """
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = max(1, slots)
+        self.fd = -1
+        self.map: mmap.mmap | bytearray | None = None
+        self.pid = 0
+
+    def open(self) -> mmap.mmap | bytearray:
+        if self.map is None or self.pid != os.getpid():
+            size = self.slots * GENERATION.size
+            if not self.path:
+                self.map = bytearray(size)
+            else:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(self.fd).st_size < size:
+                        os.ftruncate(self.fd, size)
+                finally:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+                self.map = mmap.mmap(self.fd, size)
+            self.pid = os.getpid()
+        return self.map
+
+    def offset(self, space_name: str, subpath: str) -> int:
+        digest = hashlib.blake2b(f"{space_name}/{subpath}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % self.slots * GENERATION.size
+
+    def get(self, space_name: str, subpath: str) -> int:
+        generation: int = GENERATION.unpack_from(self.open(), self.offset(space_name, subpath))[0]
+        return generation
+
+    def bump(self, space_name: str, subpaths: list[str]) -> None:
+        table = self.open()
+        offsets = {self.offset(space_name, subpath) for subpath in subpaths}
+        if self.path:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            for offset in offsets:
+                GENERATION.pack_into(table, offset, GENERATION.unpack_from(table, offset)[0] + 1)
+        finally:
+            if self.path:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class QueryCache:
+    """Read-through cache for DMART queries, invalidated by writes to the same space/subpath
+
+    The write counters are shared by the workers, so a write made through any of them hides
+    the entries it affects from all of them. Stale entries are dropped when they are next
+    looked up, or evicted by the backend like any other.
+    """
+
+    def __init__(self, backend: CacheBackend, default_ttl: int, ttls: dict[str, int], generations: SharedGenerations):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.ttls = ttls
+        self.generations = generations
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_subpath(subpath: str) -> str:
+        return subpath.strip("/")
+
+    @staticmethod
+    def key(query: QueryRequest, scope: str) -> str:
+        return f"{scope}:" + fast_json.dumps(query.model_dump(mode="json"), sort_keys=True).decode()
+
+    def ttl(self, space_name: str, subpath: str) -> int:
+        return self.ttls.get(
+            f"{space_name}/{subpath}", self.ttls.get(space_name, self.default_ttl)
+        )
+
+    async def query(
+        self,
+        query: QueryRequest,
+        fetch: Callable[..., Awaitable[ApiResponse]],
+        scope: str = "managed",
+    ) -> ApiResponse:
+        key = self.key(query, scope)
+        subpath = self.normalize_subpath(query.subpath)
+        generation = self.generations.get(query.space_name, subpath)
+        cached: tuple[int, ApiResponse] | None = self.backend.get(key)
+        if cached is not None:
+            if cached[0] == generation:
+                self.hits += 1
+                return cached[1]
+            self.backend.delete(key)
+
+        self.misses += 1
+        response = await fetch(query, scope)
+        # A write that finished while we were fetching makes this response unsafe to keep
+        if self.generations.get(query.space_name, subpath) == generation:
+            self.backend.set(key, (generation, response), self.ttl(query.space_name, subpath))
+        return response
+
+    def invalidate(self, space_name: str, subpath: str) -> None:
+        """Make stale the entries of `subpath` and of every ancestor listing that could contain it"""
+        parts = self.normalize_subpath(subpath).split("/")
+        self.generations.bump(space_name, ["/".join(parts[:depth]) for depth in range(len(parts) + 1)])
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            **self.backend.stats(),
+        }
+
+
+query_cache = QueryCache(
+    MemoryCacheBackend(settings.query_cache_max_entries),
+    settings.query_cache_ttl,
+    settings.query_cache_ttls,
+    SharedGenerations(settings.query_cache_generations_file, settings.query_cache_generation_slots),
+)
+
+query_cache_hits = registry.counter("query_cache_hits_total", "DMART queries answered from the cache")
+query_cache_misses = registry.counter("query_cache_misses_total", "DMART queries sent upstream")
+query_cache_evictions = registry.counter("query_cache_evictions_total", "Entries evicted to respect the size bound")
+query_cache_entries = registry.gauge("query_cache_entries", "Entries in the query cache")
+
+
+def collect_query_cache_metrics() -> None:
+    stats = query_cache.stats()
+    query_cache_hits.set(stats["hits"])
+    query_cache_misses.set(stats["misses"])
+    query_cache_evictions.set(stats.get("evictions", 0))
+    query_cache_entries.set(stats.get("entries", 0))
+
+
+registry.add_collector(collect_query_cache_metrics)
@@ -0,0 +1,232 @@
+"""Response compression negotiated from Accept-Encoding
+
+gzip and deflate always, zstd and br when `zstandard` / `brotli` are installed. Each body
+message is compressed as it goes out and flushed, so streamed responses (NDJSON, chunked
+listings) stay streamed, nothing is buffered beyond what the encoder holds.
+"""
+import asyncio
+import zlib
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.settings import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # type: ignore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
+
+class Encoder(ABC):
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes: ...
+
+    @abstractmethod
+    def flush(self) -> bytes:
+        """What was compressed so far, in a form the client can already decode"""
+
+    @abstractmethod
+    def finish(self) -> bytes: ...
+
+
+class ZlibEncoder(Encoder):
+    def __init__(self, level: int, wbits: int):
+        self.encoder = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.encoder.compress(data)
+
+    def flush(self) -> bytes:
+        return self.encoder.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.encoder.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder(Encoder):
+    def __init__(self, level: int):
+        if brotli is None:
+            raise RuntimeError("br needs the brotli package")
+        self.encoder = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        out: bytes = self.encoder.process(data)
+        return out
+
+    def flush(self) -> bytes:
+        out: bytes = self.encoder.flush()
+        return out
+
+    def finish(self) -> bytes:
+        out: bytes = self.encoder.finish()
+        return out
+
+
+class ZstdEncoder(Encoder):
+    def __init__(self, level: int):
+        if zstandard is None:
+            raise RuntimeError("zstd needs the zstandard package")
+        self.encoder = zstandard.ZstdCompressor(level=level).compressobj()
+        self.flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+
+    def compress(self, data: bytes) -> bytes:
+        out: bytes = self.encoder.compress(data)
+        return out
+
+    def flush(self) -> bytes:
+        out: bytes = self.encoder.flush(self.flush_mode)
+        return out
+
+    def finish(self) -> bytes:
+        out: bytes = self.encoder.flush()
+        return out
+
+
+def available_encodings() -> list[str]:
+    """`settings.compression_encodings` in order of preference, minus those whose library is missing"""
+    missing = {"br": brotli is None, "zstd": zstandard is None}
+    return [name for name in settings.compression_encodings if name in ENCODERS and not missing.get(name, False)]
+
+
+def new_encoder(encoding: str) -> Encoder:
+    return ENCODERS[encoding](settings.compression_levels.get(encoding, 6))
+
+
+ENCODERS: dict[str, Callable[[int], Encoder]] = {
+    "gzip": lambda level: ZlibEncoder(level, 16 + zlib.MAX_WBITS),
+    "deflate": lambda level: ZlibEncoder(level, zlib.MAX_WBITS),
+    "br": BrotliEncoder,
+    "zstd": ZstdEncoder,
+}
+
+
+def negotiate(accept_encoding: str, encodings: list[str]) -> str | None:
+    """The encoding the client gives the highest q, above 0, ties go to the first in `encodings`"""
+    accepted: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def min_size_for(content_type: str) -> int | None:
+    """Smallest body worth compressing for this content type, None when it is never compressed"""
+    for prefix, min_size in settings.compression_content_types.items():
+        if content_type.startswith(prefix):
+            return min_size
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.encodings = available_encodings()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.encodings:
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, CompressingSend(send, encoding).send)
+
+
+class CompressingSend:
+    """Holds the response start until the first body message tells whether compressing is worth it"""
+
+    def __init__(self, send: Send, encoding: str):
+        self.inner = send
+        self.encoding = encoding
+        self.start: Message | None = None
+        self.min_size: int | None = None
+        self.encoder: Encoder | None = None
+        self.passthrough = False
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            self.min_size = min_size_for(headers.get("content-type", ""))
+            if (
+                self.min_size is None
+                or "content-encoding" in headers
+                or message["status"] < 200
+                or message["status"] in (204, 206, 304)
+            ):
+                self.passthrough = True
+                await self.inner(message)
+                return
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.inner(message)
+            return
+
+        body: bytes = message.get("body", b"")
+        more_body: bool = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            headers = MutableHeaders(scope=start)
+            add_vary(headers)
+            declared = headers.get("content-length")
+            size = len(body) if not more_body else int(declared) if declared else None
+            if size is not None and self.min_size is not None and size < self.min_size:
+                self.passthrough = True
+                await self.inner(start)
+                await self.inner(message)
+                return
+            self.encoder = new_encoder(self.encoding)
+            headers["content-encoding"] = self.encoding
+            del headers["content-length"]
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                # The compressed representation is not byte for byte the one the tag was made for
+                headers["etag"] = f"W/{etag}"
+            await self.inner(start)
+
+        if self.encoder is None:
+            await self.inner(message)
+            return
+        data = await self.encode(self.encoder, body, more_body)
+        if data or not more_body:
+            await self.inner({"type": "http.response.body", "body": data, "more_body": more_body})
+
+    @staticmethod
+    async def encode(encoder: Encoder, body: bytes, more_body: bool) -> bytes:
+        def run() -> bytes:
+            data = encoder.compress(body) if body else b""
+            return data + (encoder.flush() if more_body else encoder.finish())
+
+        # The encoders release the GIL, large bodies are compressed off the event loop
+        if len(body) >= settings.compression_thread_min_size:
+            return await asyncio.to_thread(run)
+        return run()
+
+
+def add_vary(headers: MutableHeaders) -> None:
+    vary = headers.get("vary")
+    if not vary:
+        headers["vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower() and vary.strip() != "*":
+        headers["vary"] = f"{vary}, Accept-Encoding"
@@ -1,7 +1,411 @@
+import asyncio
+import json
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable, Hashable
+from typing import Any, TypeVar
+
+import aiohttp
+import jwt
+from pydmart.models import ActionRequest, ApiResponse, DmartException, QueryRequest
+from pydmart.models import Error as DmartError
 from pydmart.service import DmartService
 
+from utils.internal_error_code import InternalErrorCode
+from utils.metrics import (
+    dmart_call_duration,
+    dmart_call_errors,
+    dmart_session_refreshes,
+    registry,
+)
+from utils.middleware import remaining_time, set_deadline
 from utils.settings import settings
+from utils.upstream import AdaptiveLimiter, CircuitBreaker, no_time_left, out_of_time
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Runs one call per key at a time, concurrent callers with the same key await the same result
+
+    The call serves every caller, so it runs without any request's deadline, each caller
+    waits for it within its own and the call is cancelled once no caller waits any more.
+    """
+
+    def __init__(self):
+        self.calls: dict[Hashable, tuple[asyncio.Future, list[int]]] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self.calls.get(key)
+        if call is None:
+
+            async def detached() -> Any:
+                # The task runs in a copy of this caller's context, clearing the deadline there leaves the caller's alone
+                set_deadline(None)
+                return await fn()
+
+            call = (asyncio.ensure_future(detached()), [0])
+            self.calls[key] = call
+            call[0].add_done_callback(lambda _: self.calls.pop(key, None) if self.calls.get(key) is call else None)
+        else:
+            self.coalesced += 1
+
+        future, waiters = call
+        waiters[0] += 1
+        try:
+            async with asyncio.timeout(remaining_time()):
+                # shield: a cancelled waiter must not cancel the call the others are waiting on
+                return await asyncio.shield(future)
+        except (asyncio.CancelledError, TimeoutError) as e:
+            if waiters[0] == 1 and not future.done():
+                future.cancel()
+            if isinstance(e, TimeoutError):
+                raise out_of_time("DMART did not answer within the request time")
+            raise
+        finally:
+            waiters[0] -= 1
+
+
+def is_auth_failure(e: DmartException) -> bool:
+    # pydmart reports every failed response as a 400, the error type tells a rejected session apart
+    return e.status_code == 401 or e.error.type == "jwtauth"
+
+
+def never_sent(e: Exception) -> bool:
+    """The call was given up before it reached DMART, see no_time_left"""
+    return isinstance(e, DmartException) and e.error.code == InternalErrorCode.REQUEST_TIME_EXHAUSTED
+
+
+def is_upstream_failure(e: Exception) -> bool:
+    """Errors that say DMART is struggling, as opposed to it rejecting this particular call"""
+    if never_sent(e):
+        return False
+    if isinstance(e, (TimeoutError, aiohttp.ClientError)):
+        return True
+    if isinstance(e, DmartException):
+        return e.status_code >= 500 or e.error.type in ("ClientError", "ClientResponseError") or e.error.code == 500
+    return False
+
+
+def token_expiry(token: str) -> float | None:
+    """When a DMART access token expires, None if it does not say"""
+    try:
+        claims = jwt.decode(token, options={"verify_signature": False})
+    except jwt.PyJWTError:
+        return None
+    expires = claims.get("exp", claims.get("expires"))
+    return float(expires) if isinstance(expires, (int, float)) else None
+
+
+class PoolTrace:
+    """Connection pool events aiohttp reports through its tracing hooks"""
+
+    def __init__(self):
+        self.waiting = 0
+        self.created = 0
+        self.reused = 0
+
+    def config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_queued_start.append(self.queued_start)
+        trace.on_connection_queued_end.append(self.queued_end)
+        trace.on_connection_create_end.append(self.create_end)
+        trace.on_connection_reuseconn.append(self.reuseconn)
+        return trace
+
+    async def queued_start(self, *_: Any) -> None:
+        self.waiting += 1
+
+    async def queued_end(self, *_: Any) -> None:
+        self.waiting -= 1
+
+    async def create_end(self, *_: Any) -> None:
+        self.created += 1
+
+    async def reuseconn(self, *_: Any) -> None:
+        self.reused += 1
+
+
+class DmartClient(DmartService):
+    """Shared DMART client, identical concurrent queries share one upstream call"""
+
+    def __init__(self, base_url: str):
+        super().__init__(base_url)
+        self.query_flights = SingleFlight()
+        self.pool_trace = PoolTrace()
+        self.login_flight = SingleFlight()
+        self.token_expires: float | None = None
+        self.background: set[asyncio.Future] = set()
+        self.limiter = AdaptiveLimiter(
+            settings.dmart_limit_initial,
+            settings.dmart_limit_min,
+            settings.dmart_limit_max,
+            settings.dmart_limit_tolerance,
+            settings.dmart_queue_size,
+            settings.dmart_queue_timeout,
+        )
+        self.breaker = CircuitBreaker(settings.dmart_breaker_failures, settings.dmart_breaker_reset_timeout)
+
+    @staticmethod
+    def new_session(trace: PoolTrace) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings.dmart_pool_size,
+                limit_per_host=settings.dmart_pool_per_host,
+                keepalive_timeout=settings.dmart_keepalive_timeout,
+                ttl_dns_cache=settings.dmart_dns_cache_ttl,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=None, connect=settings.dmart_connect_timeout, sock_read=settings.dmart_read_timeout
+            ),
+            trace_configs=[trace.config()],
+        )
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = self.new_session(self.pool_trace)
+        return self._session
 
-dmart = DmartService(
+    async def connect(self) -> None:
+        await self._get_session()
+
+    def pool_stats(self) -> dict[str, int]:
+        connector = self._session.connector if self._session is not None and not self._session.closed else None
+        # aiohttp has no public accessor for the pool contents
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        return {
+            "limit": connector.limit if connector is not None else settings.dmart_pool_size,
+            "in_use": len(getattr(connector, "_acquired", ())),
+            "idle": idle,
+            "waiting": self.pool_trace.waiting,
+            "created": self.pool_trace.created,
+            "reused": self.pool_trace.reused,
+        }
+
+    @staticmethod
+    async def call(operation: str, fn: Callable[..., Awaitable[T]], *args: Any) -> T:
+        start = time.perf_counter()
+        try:
+            return await fn(*args)
+        except Exception:
+            dmart_call_errors.inc(operation)
+            raise
+        finally:
+            dmart_call_duration.observe(time.perf_counter() - start, operation)
+
+    async def protected(self, operation: str, fn: Callable[..., Awaitable[T]], *args: Any) -> T:
+        """Runs a call inside the circuit breaker, the adaptive concurrency limit and the request's time budget"""
+        budget = remaining_time()
+        if budget is not None and budget < settings.dmart_min_call_time:
+            raise no_time_left()
+        self.breaker.before_call()
+        try:
+            started = await self.limiter.acquire(budget)
+        except BaseException:
+            self.breaker.record(None)
+            raise
+        ok: bool | None = None
+        try:
+            response: T = await self.call(operation, self.within_budget, fn, *args)
+            ok = True
+            return response
+        except Exception as e:
+            # Calls never sent, like cancelled ones, say nothing about DMART
+            ok = None if never_sent(e) else not is_upstream_failure(e)
+            raise
+        finally:
+            self.limiter.release(
+                None if ok is None else time.monotonic() - started, started, ok is False, operation
+            )
+            self.breaker.record(ok)
+
+    @staticmethod
+    async def within_budget(fn: Callable[..., Awaitable[T]], *args: Any) -> T:
+        """Cuts the call when the request it serves runs out of time instead of letting it hold a connection"""
+        budget = remaining_time()
+        if budget is None:
+            return await fn(*args)
+        if budget < settings.dmart_min_call_time:
+            raise no_time_left()
+        try:
+            async with asyncio.timeout(budget):
+                return await fn(*args)
+        except TimeoutError:
+            raise out_of_time("DMART did not answer within the request time")
+
+    async def login(self, shortname: str, password: str) -> ApiResponse:
+        response = await self.call("login", super().login, shortname, password)
+        self.token_expires = token_expiry(self.auth_token)
+        return response
+
+    async def refresh(self, token: str, reason: str) -> None:
+        """Log in again unless the session that `token` belongs to was already replaced"""
+        if self.auth_token != token:
+            return
+
+        async def login() -> None:
+            dmart_session_refreshes.inc(reason)
+            await self.login(settings.dmart_username, settings.dmart_password)
+
+        await self.login_flight.do(token, login)
+
+    async def live_token(self) -> str:
+        """The token to call with, renewed first once expired and in the background when about to expire"""
+        token = self.auth_token
+        if self.token_expires is not None:
+            remaining = self.token_expires - time.time()
+            if remaining <= 0:
+                await self.refresh(token, "expired")
+                token = self.auth_token
+            elif remaining <= settings.dmart_token_refresh_margin and not self.login_flight.calls:
+                # Renewed in the background, this call still goes out with the current token
+                task = asyncio.ensure_future(self.refresh(token, "proactive"))
+                self.background.add(task)
+                task.add_done_callback(self.background.discard)
+        return token
+
+    async def authorized(self, operation: str, fn: Callable[..., Awaitable[T]], *args: Any) -> T:
+        """Runs a call with a live session, a call the session was rejected for is replayed once after a login"""
+        token = await self.live_token()
+        try:
+            return await self.protected(operation, fn, *args)
+        except DmartException as e:
+            if not is_auth_failure(e):
+                raise
+        await self.refresh(token, "rejected")
+        return await self.protected(operation, fn, *args)
+
+    async def transfer(self, operation: str, fn: Callable[..., Awaitable[T]], *args: Any) -> T:
+        """Like protected, minus the adaptive limit: a transfer's duration follows its size, not how loaded DMART is"""
+        self.breaker.before_call()
+        ok: bool | None = None
+        try:
+            response: T = await self.call(operation, self.within_budget, fn, *args)
+            ok = True
+            return response
+        except Exception as e:
+            # Calls never sent, like cancelled ones, say nothing about DMART
+            ok = None if never_sent(e) else not is_upstream_failure(e)
+            raise
+        finally:
+            self.breaker.record(ok)
+
+    async def upload(
+        self, space_name: str, record: dict, file_name: str, content_type: str, body: AsyncIterator[bytes]
+    ) -> ApiResponse:
+        """Streams `body` to DMART as the payload of `record`, without buffering it
+
+        The body can only be sent once, so a call the session was rejected for is not
+        replayed, the session is renewed for the next ones and the error returned.
+        """
+        token = await self.live_token()
+        try:
+            return await self.transfer("upload", self.send_upload, space_name, record, file_name, content_type, body)
+        except DmartException as e:
+            if is_auth_failure(e):
+                await self.refresh(token, "rejected")
+            raise
+
+    async def send_upload(
+        self, space_name: str, record: dict, file_name: str, content_type: str, body: AsyncIterator[bytes]
+    ) -> ApiResponse:
+        body_errors: list[Exception] = []
+
+        async def chunks() -> AsyncIterator[bytes]:
+            try:
+                async for chunk in body:
+                    yield chunk
+            except Exception as e:
+                body_errors.append(e)
+                raise
+
+        form = aiohttp.MultipartWriter("form-data")
+        form.append(space_name).set_content_disposition("form-data", name="space_name")
+        form.append(json.dumps(record), {"Content-Type": "application/json"}).set_content_disposition(
+            "form-data", name="request_record", filename="record.json"
+        )
+        payload = aiohttp.payload.AsyncIterablePayload(chunks(), content_type=content_type)
+        payload.set_content_disposition("form-data", name="payload_file", filename=file_name)
+        form.append_payload(payload)
+        try:
+            return await self._request("POST", f"{self.base_url}/managed/resource_with_payload", data=form, headers=self.headers)
+        except DmartException:
+            # A failure reading the body (too large, client gone) reaches us as a connection error, not DMART's
+            if body_errors:
+                raise body_errors[0]
+            raise
+
+    async def open_payload(self, path: str, headers: dict[str, str]) -> aiohttp.ClientResponse:
+        """The response to GET /managed/payload/`path` with its body left unread, the caller releases it"""
+        return await self.authorized("payload", self.send_open_payload, path, headers)
+
+    async def send_open_payload(self, path: str, headers: dict[str, str]) -> aiohttp.ClientResponse:
+        session = await self._get_session()
+        response = await session.get(f"{self.base_url}/managed/payload/{path}", headers={**self.headers, **headers})
+        # 416 is passed on with its Content-Range
+        if response.status < 400 or response.status == 416:
+            return response
+        try:
+            error = DmartError(**(await response.json(content_type=None))["error"])
+        except (aiohttp.ClientError, OSError, ValueError, KeyError, TypeError):
+            # Not DMART's JSON error (a proxy's page, a cut connection), the status is all there is
+            error = DmartError(type="dmart", code=response.status, message=response.reason or "Payload not available")
+        finally:
+            response.release()
+        raise DmartException(status_code=response.status, error=error)
+
+    async def request(self, action: ActionRequest) -> ApiResponse:
+        return await self.authorized("request", super().request, action)
+
+    async def query(self, query: QueryRequest, scope: str = "managed") -> ApiResponse:
+        if not settings.dmart_coalesce_queries:
+            return await self.authorized("query", super().query, query, scope)
+        # The token is part of the key so calls made under different sessions are never merged
+        key = (scope, self.auth_token, query.model_dump_json())
+        response: ApiResponse = await self.query_flights.do(
+            key, lambda: self.authorized("query", DmartService.query, self, query, scope)
+        )
+        return response
+
+
+dmart = DmartClient(
     base_url=settings.dmart_base_url,
 )
+
+dmart_coalesced_queries = registry.counter(
+    "dmart_coalesced_queries_total", "Queries answered by an identical in-flight call"
+)
+dmart_pool_connections = registry.gauge(
+    "dmart_pool_connections", "Connections to DMART by state (idle, in_use, waiting for one)", ("state",)
+)
+dmart_connections_created = registry.counter("dmart_connections_created_total", "Connections opened to DMART")
+dmart_connections_reused = registry.counter("dmart_connections_reused_total", "Calls served on a kept-alive connection")
+
+
+dmart_concurrency_limit = registry.gauge("dmart_concurrency_limit", "Adaptive limit of concurrent DMART calls")
+dmart_calls_in_flight = registry.gauge("dmart_calls_in_flight", "DMART calls holding a slot of the limit")
+dmart_calls_queued = registry.gauge("dmart_calls_queued", "DMART calls waiting for a slot")
+dmart_calls_rejected = registry.counter(
+    "dmart_calls_rejected_total", "DMART calls failed fast with a 503", ("reason",)
+)
+dmart_circuit_state = registry.gauge("dmart_circuit_state", "Circuit breaker state: 0 closed, 1 half open, 2 open")
+
+
+def collect_dmart_metrics() -> None:
+    dmart_coalesced_queries.set(dmart.query_flights.coalesced)
+    limiter = dmart.limiter.stats()
+    dmart_concurrency_limit.set(limiter["limit"])
+    dmart_calls_in_flight.set(limiter["in_flight"])
+    dmart_calls_queued.set(limiter["queued"])
+    dmart_calls_rejected.set(limiter["queue_full"], "queue_full")
+    dmart_calls_rejected.set(limiter["queue_timeout"], "queue_timeout")
+    dmart_calls_rejected.set(dmart.breaker.rejected, "circuit_open")
+    dmart_circuit_state.set(dmart.breaker.state)
+    stats = dmart.pool_stats()
+    for state in ("idle", "in_use", "waiting"):
+        dmart_pool_connections.set(stats[state], state)
+    dmart_connections_created.set(stats["created"])
+    dmart_connections_reused.set(stats["reused"])
+
+
+registry.add_collector(collect_dmart_metrics)
@@ -0,0 +1,40 @@
+"""JSON encoding for responses, error bodies and log records: orjson when installed, stdlib otherwise"""
+import json
+from typing import Any
+
+from starlette.responses import JSONResponse
+
+from utils.settings import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+# None when the stdlib encoder is used
+backend = orjson if orjson is not None and settings.json_backend == "orjson" else None
+
+
+def dumps(data: Any, sort_keys: bool = False) -> bytes:
+    if backend is not None:
+        option = backend.OPT_NON_STR_KEYS | (backend.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            encoded: bytes = backend.dumps(data, option=option)
+            return encoded
+        except TypeError:
+            # Integers past 64 bits and types orjson does not know, which the stdlib may still encode
+            pass
+    return json.dumps(
+        data, ensure_ascii=False, allow_nan=False, separators=(",", ":"), sort_keys=sort_keys
+    ).encode("utf-8")
+
+
+def loads(data: bytes | str) -> Any:
+    if backend is not None:
+        return backend.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -1,27 +1,54 @@
-import subprocess
+"""Version details of the running code
+
+Read from `build_info.json` at the project root, written once at build time with
 
+    python -m utils.git_info
 
-def git_info():
-    branch_cmd = "git rev-parse --abbrev-ref HEAD"
-    result, _ = subprocess.Popen(branch_cmd.split(" "), stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    branch = None if result is None or len(result) == 0 else result.decode().strip()
+and only asked of git when the file is missing, e.g. when running from a checkout.
+"""
+import json
+import os
+import subprocess
+from functools import lru_cache
 
-    version_cmd = "git rev-parse --short HEAD"
-    result, _ = subprocess.Popen(version_cmd.split(" "), stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    version = None if result is None or len(result) == 0 else result.decode().strip()
+BUILD_INFO_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "build_info.json")
 
-    tag_cmd = "git describe --tags"
-    result, _ = subprocess.Popen(tag_cmd.split(" "), stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    tag = None if result is None or len(result) == 0 else result.decode().strip()
 
-    version_date_cmd = "git show --pretty=format:'%ad'"
-    result, _ = subprocess.Popen(version_date_cmd.split(" "), stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE).communicate()
-    version_date = None if result is None or len(result) == 0 else result.decode().split("\n")[0]
+def run_git(*args: str) -> str | None:
+    try:
+        result, _ = subprocess.Popen(["git", *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+    except OSError:
+        # No git in the image
+        return None
+    return None if result is None or len(result) == 0 else result.decode().strip()
 
+
+def read_git() -> dict:
+    version_date = run_git("show", "--pretty=format:'%ad'")
     return {
-        "commit_hash": version,
-        "date": version_date,
-        "branch": branch,
-        "tag": tag
-    }
\ No newline at end of file
+        "commit_hash": run_git("rev-parse", "--short", "HEAD"),
+        "date": None if version_date is None else version_date.split("\n")[0],
+        "branch": run_git("rev-parse", "--abbrev-ref", "HEAD"),
+        "tag": run_git("describe", "--tags"),
+    }
+
+
+@lru_cache
+def git_info() -> dict:
+    try:
+        with open(BUILD_INFO_FILE) as file:
+            info: dict = json.load(file)
+            return info
+    except (OSError, ValueError):
+        return read_git()
+
+
+def write_build_info(path: str = BUILD_INFO_FILE) -> dict:
+    info = read_git()
+    with open(path, "w") as file:
+        json.dump(info, file)
+    return info
+
+
+if __name__ == "__main__":
+    print(json.dumps(write_build_info()))
@@ -1,8 +1,16 @@
+import os
+import shutil
 from utils.settings import settings
 # from os import cpu_count
 from fastapi.logger import logger
 from utils.logger import logging_schema
 
+# Loaded once by the parent before the workers start: drop the snapshots of a previous run
+if settings.metrics_dir:
+    shutil.rmtree(settings.metrics_dir, ignore_errors=True)
+if os.path.exists(settings.rate_limit_file):
+    os.remove(settings.rate_limit_file)
+
 
 bind = [f"{settings.listening_host}:{settings.listening_port}"]
 workers = 2
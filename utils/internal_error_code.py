@@ -51,3 +51,10 @@ class InternalErrorCode:
     EXPIRED_TOKEN = 48
     NOT_AUTHENTICATED = 49
     SESSION = 50
+    UPSTREAM_UNAVAILABLE = 503
+    UPSTREAM_TIMEOUT = 504
+    REQUEST_TIME_EXHAUSTED = 506
+    RATE_LIMITED = 429
+    FILE_TOO_LARGE = 413
+    RANGE_NOT_SATISFIABLE = 416
+    HASHING_BUSY = 507
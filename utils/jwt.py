@@ -1,14 +1,78 @@
+import hashlib
 import jwt
+from collections import OrderedDict
 from time import time
 from typing import Optional, Any
 from fastapi import Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydmart.models import DmartException, Error as DmartError
 
+from utils.metrics import registry
 from utils.settings import settings
 
 
+class TokenCache:
+    """LRU of already verified tokens, each entry lives until the token's own `expires` claim"""
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[bytes, tuple[float, dict[str, Any]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> dict[str, Any] | None:
+        key = self.key(token)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, token: str, decoded_token: dict[str, Any]) -> None:
+        if self.max_size <= 0:
+            return
+        key = self.key(token)
+        self.entries[key] = (min(decoded_token["expires"], time() + self.ttl), decoded_token)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+token_cache = TokenCache(settings.jwt_cache_size, settings.jwt_cache_ttl)
+
+jwt_cache_hits = registry.counter("jwt_cache_hits_total", "Tokens found in the verified token cache")
+jwt_cache_misses = registry.counter("jwt_cache_misses_total", "Tokens decoded and verified")
+jwt_cache_entries = registry.gauge("jwt_cache_entries", "Tokens in the verified token cache")
+jwt_rejected_tokens = registry.counter("jwt_rejected_tokens_total", "Presented tokens that failed verification")
+
+
+def collect_token_cache_metrics() -> None:
+    stats = token_cache.stats()
+    jwt_cache_hits.set(stats["hits"])
+    jwt_cache_misses.set(stats["misses"])
+    jwt_cache_entries.set(stats["size"])
+
+
+registry.add_collector(collect_token_cache_metrics)
+
+
 async def decode_jwt(token: str) -> dict[str, Any]:
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+
     decoded_token: dict[str, Any] = {}
     try:
         decoded_token = jwt.decode(
@@ -34,6 +98,7 @@ async def decode_jwt(token: str) -> dict[str, Any]:
             DmartError(type="jwtauth", code=13, message="Expired Token"),
         )
 
+    token_cache.set(token, decoded_token)
     return decoded_token
 
 
@@ -46,6 +111,19 @@ class JWTBearer:
         self.is_required = is_required
 
     async def __call__(self, request: Request) -> tuple[str, str]:  # Changed return type
+        # The outcome is kept on the request so the route and the logging middleware decode once
+        result = getattr(request.state, "jwt_auth", None)
+        if result is None:
+            try:
+                result = await self.authenticate(request)
+            except DmartException as e:
+                result = e
+            request.state.jwt_auth = result
+        if isinstance(result, DmartException):
+            raise result
+        return result
+
+    async def authenticate(self, request: Request) -> tuple[str, str]:
         auth_token: str | None = None
         try:
             credentials: Optional[HTTPAuthorizationCredentials] = await self.http_bearer.__call__(request)
@@ -60,9 +138,14 @@ class JWTBearer:
                 DmartError(type="jwtauth", code=13, message="Not authenticated [1]"),
             )
 
-        decoded: dict[str, Any] = await decode_jwt(auth_token)
+        try:
+            decoded: dict[str, Any] = await decode_jwt(auth_token)
+        except DmartException:
+            jwt_rejected_tokens.inc()
+            raise
         if isinstance(decoded, dict) and decoded and "data" in decoded and "shortname" in decoded["data"] and str(decoded["data"]["shortname"]) and "type" in decoded["data"]:
             return str(decoded["data"]["shortname"]), auth_token
+        jwt_rejected_tokens.inc()
         raise DmartException(
             status.HTTP_401_UNAUTHORIZED,
             DmartError(type="jwtauth", code=13, message="Not authenticated [2]"),
@@ -1,8 +1,12 @@
-import json
 import logging
 import logging.config
 import os
+import queue
+import random
+import threading
 
+from utils import fast_json
+from utils.metrics import registry
 from utils.settings import settings
 
 
@@ -14,6 +18,9 @@ class CustomFormatter(logging.Formatter):
         super().__init__()
 
     def format(self, record):
+        preformatted = getattr(record, "preformatted", None)
+        if preformatted is not None:
+            return preformatted
         correlation_id = getattr(record, "correlation_id", "")
         if correlation_id == "ROOT" and getattr(record, "props", None):
             correlation_id = getattr(record, "props", {})\
@@ -30,7 +37,134 @@ class CustomFormatter(logging.Formatter):
             # "lineno": record.lineno,
             # "funcName": record.funcName,
         }
-        return json.dumps(data)
+        return fast_json.dumps(data).decode()
+
+
+class QueueLogHandler(logging.Handler):
+    """Hands records to a background writer thread that formats and writes them in batches
+
+    Filters configured on this handler run in the caller's context (e.g. the correlation id),
+    the target handlers only format and write. When the queue is full the record is handled
+    according to `overflow`: "block" waits for room, "drop" discards it and "sample" starts
+    keeping only a `sample_rate` fraction of INFO records once the queue is half full.
+    """
+
+    def __init__(
+        self,
+        handlers: list,
+        queue_size: int = 10000,
+        overflow: str = "drop",
+        sample_rate: float = 0.1,
+        batch_size: int = 256,
+    ):
+        super().__init__()
+        # Indexed access so dictConfig resolves the "cfg://handlers.x" references
+        self.targets: list[logging.Handler] = [handlers[i] for i in range(len(handlers))]
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_writer(self) -> None:
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            # After a fork the parent's writer thread does not exist in the child
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._writer, name="log-writer", daemon=True)
+            self._thread.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self._ensure_writer()
+        try:
+            if self.overflow == "block":
+                self.queue.put(self.prepare(record))
+            elif (
+                self.overflow == "sample"
+                and record.levelno < logging.WARNING
+                and self.queue.qsize() * 2 >= self.queue.maxsize
+                and random.random() >= self.sample_rate
+            ):
+                self.dropped += 1
+                return
+            else:
+                self.queue.put_nowait(self.prepare(record))
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+        except (TypeError, ValueError):
+            # A message whose arguments do not fit its format string
+            self.handleError(record)
+
+    def _writer(self) -> None:
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            batch = [record]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+            self.write(batch)
+            if stop:
+                return
+
+    def write(self, batch: list[logging.LogRecord]) -> None:
+        for handler in self.targets:
+            records = [record for record in batch if record.levelno >= handler.level]
+            if not records:
+                continue
+            try:
+                # One write (and one file lock) per batch instead of per record
+                lines = "\n".join(handler.format(record) for record in records)
+                handler.handle(logging.makeLogRecord({
+                    "name": records[-1].name,
+                    "levelno": max(record.levelno for record in records),
+                    "levelname": logging.getLevelName(max(record.levelno for record in records)),
+                    "msg": "",
+                    "preformatted": lines,
+                }))
+            except (OSError, TypeError, ValueError):
+                # Unwritable target or a record the formatter cannot encode, the writer thread goes on
+                self.handleError(records[-1])
+        self.written += len(batch)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "pending": self.queue.qsize(),
+        }
+
+    def close(self) -> None:
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(timeout=5)
+        self._thread = None
+        super().close()
 
 
 logging_schema : dict = {
@@ -61,10 +195,19 @@ logging_schema : dict = {
             "use_gzip": False,
             "formatter": "json",
         },
+        "queue": {
+            "()": QueueLogHandler,
+            "filters": ["correlation_id"],
+            "handlers": [f"cfg://handlers.{handler}" for handler in settings.log_handlers],
+            "queue_size": settings.log_queue_size,
+            "overflow": settings.log_queue_overflow,
+            "sample_rate": settings.log_queue_sample_rate,
+            "batch_size": settings.log_batch_size,
+        },
     },
     "loggers": {
         "fastapi": {
-            "handlers": settings.log_handlers,
+            "handlers": ["queue"] if settings.log_async_enabled else settings.log_handlers,
             "level": logging.INFO,
             "propagate": True,
         }
@@ -77,3 +220,23 @@ def changeLogFile(log_file: str | None = None) -> None:
     if (log_file and "handlers" in logging_schema and "file" in logging_schema["handlers"]
         and "filename" in logging_schema["handlers"]["file"]):
         logging_schema["handlers"]["file"]["filename"] = log_file
+
+
+def log_queue_stats() -> dict[str, int]:
+    for handler in logging.getLogger("fastapi").handlers:
+        if isinstance(handler, QueueLogHandler):
+            return handler.stats()
+    return {}
+
+
+log_records_dropped = registry.counter("log_records_dropped_total", "Log records dropped by a full queue")
+log_queue_pending = registry.gauge("log_queue_pending", "Log records waiting for the writer thread")
+
+
+def collect_log_queue_metrics() -> None:
+    stats = log_queue_stats()
+    log_records_dropped.set(stats.get("dropped", 0))
+    log_queue_pending.set(stats.get("pending", 0))
+
+
+registry.add_collector(collect_log_queue_metrics)
@@ -0,0 +1,276 @@
+"""In-process metrics registry rendered in the Prometheus text format
+
+Each worker process keeps its own registry and periodically publishes a snapshot to
+`settings.metrics_dir`. The /metrics route merges the snapshots of every worker, so a
+scrape reports the service as a whole whichever worker answers it. Snapshots are taken on
+the event loop, which is the only writer of the values, only the file I/O runs in a thread.
+"""
+import asyncio
+import copy
+import json
+import os
+import time
+from collections.abc import Callable
+from typing import Any, TypeVar
+
+from fastapi.logger import logger
+
+from utils.settings import settings
+
+M = TypeVar("M", bound="Metric")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values: dict[tuple[str, ...], Any] = {}
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "description": self.description,
+            "labels": list(self.labels),
+            "values": [[list(key), value] for key, value in self.values.items()],
+        }
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, value: float, *labels: str) -> None:
+        """For totals counted elsewhere (e.g. cache hits), see Registry.add_collector"""
+        self.values[labels] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str) -> None:
+        # [per bucket counts (not cumulative), sum, count]
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            **super().snapshot(),
+            # The entries are mutated in place, the snapshot gets copies
+            "values": [[list(key), [list(entry[0]), entry[1], entry[2]]] for key, entry in self.values.items()],
+            "buckets": list(self.buckets),
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.collectors: list[Callable[[], None]] = []
+
+    def register(self, metric: M) -> M:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(
+        self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """`collector` updates gauges/counters from stats kept elsewhere, it runs before every snapshot"""
+        self.collectors.append(collector)
+
+    def snapshot(self) -> dict[str, Any]:
+        for collector in self.collectors:
+            collector()
+        return {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "metrics": {name: metric.snapshot() for name, metric in self.metrics.items()},
+        }
+
+    def snapshot_path(self, pid: int) -> str:
+        return os.path.join(settings.metrics_dir, f"{pid}.json")
+
+    def publish(self, snapshot: dict[str, Any] | None = None) -> None:
+        if not settings.metrics_dir:
+            return
+        if snapshot is None:
+            snapshot = self.snapshot()
+        os.makedirs(settings.metrics_dir, exist_ok=True)
+        path = self.snapshot_path(os.getpid())
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(snapshot, file)
+        os.replace(f"{path}.tmp", path)
+
+    async def publish_forever(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.publish, self.snapshot())
+            except (OSError, ValueError):
+                # Full disk, unwritable directory, a value JSON refuses: the next round tries again
+                logger.exception("Failed to publish the metrics snapshot")
+            await asyncio.sleep(settings.metrics_publish_interval)
+
+    def prune(self) -> None:
+        """Drop the snapshots of processes that are gone, run when a worker starts
+
+        Without it the totals of a previous run would be added to this one's for good.
+        """
+        if not settings.metrics_dir or not os.path.isdir(settings.metrics_dir):
+            return
+        for file_name in os.listdir(settings.metrics_dir):
+            pid = file_name.partition(".")[0]
+            if pid.isdigit() and int(pid) != os.getpid() and not is_alive(int(pid)):
+                try:
+                    os.remove(os.path.join(settings.metrics_dir, file_name))
+                except FileNotFoundError:
+                    pass
+
+    def worker_snapshots(self, own: dict[str, Any]) -> list[dict[str, Any]]:
+        """`own`, this process' live snapshot, plus the last published one of every other worker"""
+        snapshots = [own]
+        if not settings.metrics_dir or not os.path.isdir(settings.metrics_dir):
+            return snapshots
+        for file_name in os.listdir(settings.metrics_dir):
+            if not file_name.endswith(".json") or file_name == f"{os.getpid()}.json":
+                continue
+            try:
+                with open(os.path.join(settings.metrics_dir, file_name)) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            snapshot["alive"] = is_alive(snapshot["pid"])
+            snapshots.append(snapshot)
+        return snapshots
+
+    def render(self, own: dict[str, Any]) -> str:
+        """The merged metrics of every worker, `own` is this process' snapshot taken on the event loop"""
+        merged: dict[str, dict[str, Any]] = {}
+        for snapshot in self.worker_snapshots(own):
+            for name, metric in snapshot["metrics"].items():
+                # Counters and histograms of exited workers still count, their gauges do not
+                if metric["kind"] == "gauge" and not snapshot.get("alive", True):
+                    continue
+                merge(merged.setdefault(name, {**metric, "values": {}}), metric)
+        return "".join(render_metric(name, metric) for name, metric in merged.items())
+
+
+async def monitor_event_loop(interval: float) -> None:
+    """Records how late a periodic timer fires, anything blocking the loop shows up here"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - start - interval))
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(target: dict[str, Any], metric: dict[str, Any]) -> None:
+    for labels, value in metric["values"]:
+        key = tuple(labels)
+        current = target["values"].get(key)
+        if current is None:
+            target["values"][key] = copy.deepcopy(value)
+        elif metric["kind"] == "histogram":
+            current[0] = [a + b for a, b in zip(current[0], value[0])]
+            current[1] += value[1]
+            current[2] += value[2]
+        else:
+            target["values"][key] = current + value
+
+
+def format_labels(names: list[str], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_metric(name: str, metric: dict[str, Any]) -> str:
+    lines = [f"# HELP {name} {metric['description']}", f"# TYPE {name} {metric['kind']}"]
+    for labels, value in metric["values"].items():
+        if metric["kind"] != "histogram":
+            lines.append(f"{name}{format_labels(metric['labels'], labels)} {value}")
+            continue
+        cumulative = 0
+        for bound, count in zip(metric["buckets"], value[0]):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{name}_bucket{format_labels(metric['labels'], labels, le)} {cumulative}")
+        le = 'le="+Inf"'
+        lines.append(f"{name}_bucket{format_labels(metric['labels'], labels, le)} {value[2]}")
+        lines.append(f"{name}_sum{format_labels(metric['labels'], labels)} {value[1]}")
+        lines.append(f"{name}_count{format_labels(metric['labels'], labels)} {value[2]}")
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "Requests served", ("method", "route", "status")
+)
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time to serve a request", ("method", "route")
+)
+http_requests_in_flight = registry.gauge("http_requests_in_flight", "Requests being served")
+http_request_timeouts = registry.counter(
+    "http_request_timeouts_total", "Requests cut by the request_timeout guard"
+)
+dmart_call_duration = registry.histogram(
+    "dmart_call_duration_seconds", "Duration of DMART calls", ("operation",)
+)
+dmart_call_errors = registry.counter("dmart_call_errors_total", "Failed DMART calls", ("operation",))
+dmart_session_refreshes = registry.counter(
+    "dmart_session_refreshes_total", "Logins made to renew the DMART session", ("reason",)
+)
+event_loop_lag = registry.histogram(
+    "event_loop_lag_seconds",
+    "Delay of a periodic timer on the event loop",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
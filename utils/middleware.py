@@ -1,84 +1,110 @@
-from contextvars import ContextVar
-from typing import Any
-from starlette.types import ASGIApp, Receive, Scope, Send
-from starlette.requests import Request
+import asyncio
+import re
+from contextvars import ContextVar, Token
+from uuid import uuid4
+from asgi_correlation_id.context import correlation_id
+from starlette.types import Scope
 from utils.internal_error_code import InternalErrorCode
-from utils.settings import settings
 from fastapi import status
 from pydmart.models import Error as DmartError, DmartException
 
 REQUEST_DATA_CTX_KEY = "request_data"
+DEADLINE_CTX_KEY = "deadline"
 
 _request_data_ctx_var: ContextVar[dict] = ContextVar(REQUEST_DATA_CTX_KEY, default={})
+_deadline_ctx_var: ContextVar[asyncio.Timeout | None] = ContextVar(DEADLINE_CTX_KEY, default=None)
 
 def get_request_data() -> dict:
     return _request_data_ctx_var.get()
 
-class CustomRequestMiddleware:
-    def __init__(
-        self,
-        app: ASGIApp,
-    ) -> None:
-        self.app = app
+def set_request_data(scope: Scope) -> Token:
+    request_headers = {}
+    for key, value in scope["headers"]:
+        name = key.decode("latin-1")
+        if name in ['cookie', 'authorization']:
+            continue
+        request_headers[name] = value.decode("latin-1")
 
-    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
-        if scope["type"] not in ["http", "websocket"]:
-           try:
-               await self.app(scope, receive, send)
-           except Exception as _:
-               return
+    return _request_data_ctx_var.set({
+        "request_headers": request_headers,
+    })
 
 
-        request = Request(scope, receive)
-        request_headers = {}
-        for k,v in request.headers.items():
-            if k in ['cookie', 'authorization']:
-                continue
-            request_headers[k] = v
+def reset_request_data(token: Token) -> None:
+    _request_data_ctx_var.reset(token)
 
-        request_data = _request_data_ctx_var.set({
-            "request_headers": request_headers,
-        })
 
-        await self.app(scope, receive, send)
+def set_deadline(deadline: asyncio.Timeout | None) -> Token:
+    """The request_timeout guard of the current request, rescheduling it moves the deadline everywhere
 
-        _request_data_ctx_var.reset(request_data)
+    None detaches the current task from the request's deadline.
+    """
+    return _deadline_ctx_var.set(deadline)
 
 
-class ChannelMiddleware:
-    def __init__(
-        self,
-        app: ASGIApp,
-    ) -> None:
-        self.app = app
+def reset_deadline(token: Token) -> None:
+    _deadline_ctx_var.reset(token)
 
-    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
-        if scope["type"] not in ["http", "websocket"]:
-            await self.app(scope, receive, send)
-            return
 
-        request = Request(scope, receive)
-        channel_key = request.headers.get("x-channel-key")
+def extend_deadline(seconds: float) -> None:
+    """Gives the current request `seconds` from now, for routes whose time follows the size of what they transfer"""
+    deadline = _deadline_ctx_var.get()
+    if deadline is not None and deadline.when() is not None:
+        deadline.reschedule(asyncio.get_running_loop().time() + seconds)
+
+
+def remaining_time() -> float | None:
+    """Seconds left of the request's time budget, None outside a request or once its response started"""
+    deadline = _deadline_ctx_var.get()
+    when = deadline.when() if deadline is not None else None
+    if when is None:
+        return None
+    return when - asyncio.get_running_loop().time()
+
+
+def set_correlation_id(scope: Scope, header_name: bytes = b"x-correlation-id") -> str:
+    """Reuse the caller's correlation id or generate one, available to the log filter from here on"""
+    value = get_header(scope, header_name) or uuid4().hex
+    correlation_id.set(value)
+    return value
+
+
+def combine_patterns(patterns: list) -> re.Pattern | None:
+    """One alternation regex matching whenever any of the patterns would"""
+    sources = [pattern.pattern if isinstance(pattern, re.Pattern) else pattern for pattern in patterns]
+    if not sources:
+        return None
+    return re.compile("|".join(f"(?:{source})" for source in sources))
+
+
+class ChannelIndex:
+    """`settings.channels` compiled once: channel key -> allowed paths regex"""
+
+    def __init__(self, channels: list):
+        self.channels: dict[str, re.Pattern | None] = {}
+        all_patterns: list = []
+        for channel in channels:
+            allowed = combine_patterns(channel["allowed_api_patterns"])
+            all_patterns.extend(channel["allowed_api_patterns"])
+            for key in channel.get("keys", []):
+                self.channels.setdefault(key, allowed)
+        # Paths that belong to a channel are forbidden to requests without a channel key
+        self.unauthenticated_deny = combine_patterns(all_patterns)
+
+    def check(self, scope: Scope) -> None:
+        """Raise a 403 DmartException unless the request's channel may call the requested path"""
+        channel_key = get_header(scope, b"x-channel-key")
         if not channel_key:
-            for channel in settings.channels:
-                for pattern in channel["allowed_api_patterns"]:
-                    if pattern.search(request.scope['path']):
-                        raise DmartException(
-                            status_code=status.HTTP_403_FORBIDDEN,
-                            error=DmartError(
-                                type="channel_auth", code=InternalErrorCode.NOT_ALLOWED, message="Requested method or path is forbidden"
-                            ),
-                        )
-            await self.app(scope, receive, send)
+            if self.unauthenticated_deny and self.unauthenticated_deny.search(scope["path"]):
+                raise DmartException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    error=DmartError(
+                        type="channel_auth", code=InternalErrorCode.NOT_ALLOWED, message="Requested method or path is forbidden"
+                    ),
+                )
             return
 
-        request_channel: dict[str, Any] | None = None
-        for channel in settings.channels:
-            if channel_key in channel.get("keys", []):
-                request_channel = channel
-                break
-
-        if not request_channel:
+        if channel_key not in self.channels:
             raise DmartException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 error=DmartError(
@@ -86,14 +112,19 @@ class ChannelMiddleware:
                 ),
             )
 
-        for pattern in request_channel["allowed_api_patterns"]:
-            if pattern.search(request.scope['path']):
-                await self.app(scope, receive, send)
-                return
-            
-        raise DmartException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            error=DmartError(
-                type="channel_auth", code=InternalErrorCode.NOT_ALLOWED, message="Requested method or path is forbidden [3]"
-            ),
-        )
+        allowed = self.channels[channel_key]
+        if not allowed or not allowed.search(scope["path"]):
+            raise DmartException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                error=DmartError(
+                    type="channel_auth", code=InternalErrorCode.NOT_ALLOWED, message="Requested method or path is forbidden [3]"
+                ),
+            )
+
+
+def get_header(scope: Scope, name: bytes) -> str | None:
+    for key, value in scope["headers"]:
+        if key == name:
+            return str(value.decode("latin-1"))
+    return None
+
@@ -1,10 +1,32 @@
+import asyncio
+import concurrent.futures
+import os
+import time
+from collections.abc import Callable
+from functools import lru_cache
+from typing import Any
+
 from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from fastapi import status
+from pydmart.models import DmartException
+from pydmart.models import Error as DmartError
+
+from utils.internal_error_code import InternalErrorCode
+from utils.metrics import registry
+from utils.settings import settings
+
+
+@lru_cache
+def hasher(memory_cost: int, time_cost: int, parallelism: int) -> PasswordHasher:
+    return PasswordHasher(memory_cost=memory_cost, time_cost=time_cost, parallelism=parallelism)
 
-ph = PasswordHasher(
-    memory_cost=102400,
-    time_cost=1,
-    parallelism=8
-)
+
+def hasher_parameters() -> tuple[int, int, int]:
+    return settings.password_hash_memory_cost, settings.password_hash_time_cost, settings.password_hash_parallelism
+
+
+ph = hasher(*hasher_parameters())
 
 def verify_password(plain_password: str, hashed_password: str):
     try:
@@ -14,3 +36,127 @@ def verify_password(plain_password: str, hashed_password: str):
 
 def hash_password(password: str):
     return ph.hash(password)
+
+
+# Module level so the process pool can run them, a worker builds its hasher once per parameter set
+def hash_with(parameters: tuple[int, int, int], password: str) -> str:
+    return hasher(*parameters).hash(password)
+
+
+def verify_with(parameters: tuple[int, int, int], hashed_password: str, plain_password: str) -> tuple[bool, str | None]:
+    one = hasher(*parameters)
+    try:
+        one.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False, None
+    return True, one.hash(plain_password) if one.check_needs_rehash(hashed_password) else None
+
+
+def busy() -> DmartException:
+    return DmartException(
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        DmartError(type="password", code=InternalErrorCode.HASHING_BUSY, message="Too many password checks in progress"),
+    )
+
+
+class HashingService:
+    """Argon2 off the event loop, at most `concurrency` hashes at a time on a thread or process pool
+
+    Each hash takes memory_cost KiB while it runs, the cap bounds that memory and leaves the
+    CPUs to the rest of the service. Up to `queue_size` calls wait for a turn, at most
+    `queue_timeout` seconds, further ones fail with a 503. argon2 releases the GIL, so the
+    thread pool hashes in parallel, the process pool keeps the hashing memory out of the worker.
+    """
+
+    def __init__(self, concurrency: int, queue_size: int, queue_timeout: float, executor: str = "thread"):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.executor_kind = executor
+        self.executor: concurrent.futures.Executor | None = None
+        self.pid = 0
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def get_executor(self) -> concurrent.futures.Executor:
+        # A pool inherited from the parent process has no threads/processes behind it
+        if self.executor is None or self.pid != os.getpid():
+            if self.executor_kind == "process":
+                self.executor = concurrent.futures.ProcessPoolExecutor(self.concurrency)
+            else:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.concurrency, thread_name_prefix="argon2")
+            self.pid = os.getpid()
+        return self.executor
+
+    async def run(self, operation: str, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.semaphore.locked() and self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise busy()
+        self.waiting += 1
+        try:
+            async with asyncio.timeout(self.queue_timeout):
+                await self.semaphore.acquire()
+        except TimeoutError:
+            self.rejected += 1
+            raise busy()
+        finally:
+            self.waiting -= 1
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.running += 1
+
+        def done(_: concurrent.futures.Future) -> None:
+            # The slot is freed when the hash is actually over, not when a cancelled caller stops waiting
+            self.running -= 1
+            self.semaphore.release()
+            password_hash_duration.observe(time.perf_counter() - start, operation)
+
+        try:
+            future = self.get_executor().submit(fn, *args)
+        except BaseException:
+            self.running -= 1
+            self.semaphore.release()
+            raise
+        future.add_done_callback(lambda one: loop.call_soon_threadsafe(done, one))
+        return await asyncio.wrap_future(future)
+
+    async def hash(self, password: str) -> str:
+        hashed: str = await self.run("hash", hash_with, hasher_parameters(), password)
+        return hashed
+
+    async def verify(self, plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+        """Whether the password matches, and its new hash when `hashed_password` used other parameters than the current ones"""
+        result: tuple[bool, str | None] = await self.run("verify", verify_with, hasher_parameters(), hashed_password, plain_password)
+        return result
+
+    def close(self) -> None:
+        if self.executor is not None and self.pid == os.getpid():
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+
+
+hashing = HashingService(
+    settings.password_hash_concurrency,
+    settings.password_hash_queue_size,
+    settings.password_hash_queue_timeout,
+    settings.password_hash_executor,
+)
+
+password_hash_duration = registry.histogram(
+    "password_hash_duration_seconds", "Time to hash or verify a password on the pool", ("operation",)
+)
+password_hashes_running = registry.gauge("password_hashes_running", "Password hashes being computed")
+password_hashes_queued = registry.gauge("password_hashes_queued", "Password hashes waiting for a turn")
+password_hashes_rejected = registry.counter("password_hashes_rejected_total", "Password hashes refused with a 503")
+
+
+def collect_hashing_metrics() -> None:
+    password_hashes_running.set(hashing.running)
+    password_hashes_queued.set(hashing.waiting)
+    password_hashes_rejected.set(hashing.rejected)
+
+
+registry.add_collector(collect_hashing_metrics)
@@ -0,0 +1,164 @@
+import asyncio
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+
+from fastapi import status
+from pydmart.models import DmartException
+from pydmart.models import Error as DmartError
+
+from utils.internal_error_code import InternalErrorCode
+from utils.metrics import registry
+
+SLOT = struct.Struct("<Qdd")  # key hash, tokens, last refill (time.monotonic, shared by the processes of a host)
+PROBES = 8
+LOCK_ATTEMPTS = 10
+LOCK_RETRY_DELAY = 0.001
+
+rate_limited_requests = registry.counter(
+    "rate_limited_requests_total", "Requests rejected with a 429", ("kind",)
+)
+
+
+class RateLimitExceeded(DmartException):
+    def __init__(self, kind: str, retry_after: float):
+        super().__init__(
+            status.HTTP_429_TOO_MANY_REQUESTS,
+            DmartError(type="rate_limit", code=InternalErrorCode.RATE_LIMITED, message=f"Too many requests for this {kind}"),
+        )
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class SharedBuckets:
+    """Token buckets in a memory mapped file, so every worker process of the host draws from the same ones
+
+    The file is a fixed table of `slots` buckets addressed by a hash of the key with a short
+    linear probe. When the probed slots are all taken the least recently used one is reset,
+    which can only make a limit more lenient, never stricter.
+    """
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = slots
+        self.fd = -1
+        self.map: mmap.mmap | None = None
+        self.pid = 0
+
+    def open(self) -> mmap.mmap:
+        # Mappings are not shared with a forked child in a useful way, each worker opens its own
+        if self.map is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            size = self.slots * SLOT.size
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.fd).st_size < size:
+                    os.ftruncate(self.fd, size)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.map = mmap.mmap(self.fd, size)
+            self.pid = os.getpid()
+        return self.map
+
+    async def lock(self) -> bool:
+        """Take the file lock without blocking the event loop, False when another worker keeps it"""
+        for _ in range(LOCK_ATTEMPTS):
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                await asyncio.sleep(LOCK_RETRY_DELAY)
+        return False
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """Take one token from `key`'s bucket, returns 0 or the seconds until one is available"""
+        table = self.open()
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+        start = key_hash % self.slots
+        if not await self.lock():
+            # A take holds the lock for microseconds, rather let the request through than stall it
+            return 0.0
+        try:
+            # Read under the lock, no other worker can have written a later time since
+            now = time.monotonic()
+            offset: int | None = None
+            oldest, oldest_time = start * SLOT.size, math.inf
+            for i in range(PROBES):
+                candidate = (start + i) % self.slots * SLOT.size
+                slot_hash, _, updated = SLOT.unpack_from(table, candidate)
+                if slot_hash in (key_hash, 0):
+                    offset = candidate
+                    break
+                if updated > now:
+                    updated = -math.inf  # Left by a previous boot, the first to go
+                if updated < oldest_time:
+                    oldest, oldest_time = candidate, updated
+            if offset is None:
+                offset = oldest
+            slot_hash, tokens, updated = SLOT.unpack_from(table, offset)
+            if slot_hash != key_hash or updated > now:
+                # A bucket from the future was written before a reboot restarted the monotonic clock
+                tokens, updated = burst, now
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate if rate > 0 else 60.0
+            SLOT.pack_into(table, offset, key_hash, tokens, now)
+            return wait
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    """Limits from `settings.channels` entries: `rate_limit` per channel key, `user_rate_limit` per JWT shortname
+
+    Both are {"rate": requests per second, "burst": bucket size}. `default_user_limit` applies
+    to the users of requests whose channel sets no user_rate_limit, or that have no channel.
+    A user has one bucket whatever the channel, the channel only picks its rate and burst.
+    """
+
+    def __init__(self, channels: list, default_user_limit: dict, buckets: SharedBuckets):
+        self.buckets = buckets
+        self.channel_limits: dict[str, tuple[float, float]] = {}
+        self.user_limits: dict[str, tuple[float, float]] = {}
+        for channel in channels:
+            for key in channel.get("keys", []):
+                if channel.get("rate_limit"):
+                    self.channel_limits.setdefault(key, self.parse(channel["rate_limit"]))
+                if channel.get("user_rate_limit"):
+                    self.user_limits.setdefault(key, self.parse(channel["user_rate_limit"]))
+        self.default_user_limit = self.parse(default_user_limit) if default_user_limit else None
+
+    @staticmethod
+    def parse(limit: dict) -> tuple[float, float]:
+        rate = float(limit["rate"])
+        return rate, float(limit.get("burst", max(1.0, rate)))
+
+    @property
+    def limits_users(self) -> bool:
+        return bool(self.user_limits) or self.default_user_limit is not None
+
+    async def check(self, channel_key: str | None, user_shortname: str | None) -> None:
+        """Raise a 429 RateLimitExceeded when the channel or the user is over its limit"""
+        limit = self.channel_limits.get(channel_key) if channel_key else None
+        if limit is not None:
+            wait = await self.buckets.take(f"channel:{channel_key}", *limit)
+            if wait:
+                rate_limited_requests.inc("channel")
+                raise RateLimitExceeded("channel", wait)
+
+        if not user_shortname:
+            return
+        limit = self.user_limits.get(channel_key or "", self.default_user_limit)
+        if limit is None:
+            return
+        wait = await self.buckets.take(f"user:{user_shortname}", *limit)
+        if wait:
+            rate_limited_requests.inc("user")
+            raise RateLimitExceeded("user", wait)
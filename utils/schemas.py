@@ -0,0 +1,132 @@
+"""JSON schemas of the spaces, to validate payloads here before they are sent to DMART
+
+The schemas are loaded at startup from `settings.spaces_folder` (the same tree DMART is
+seeded from) or from DMART itself, see `settings.schemas_source`. Each one is compiled
+into a validator the first time it is used and the validator is kept. Valid payloads are
+checked with fastjsonschema's generated code when it is installed, jsonschema describes
+what is wrong with the others.
+"""
+import json
+import os
+from collections.abc import Awaitable, Callable
+from typing import Any, cast
+
+from fastapi.logger import logger
+from jsonschema.exceptions import best_match
+from jsonschema.protocols import Validator
+from jsonschema.validators import validator_for
+from pydmart.enums import QueryType, ResourceType
+from pydmart.models import ApiResponse, QueryRequest
+
+from utils.metrics import registry
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None  # type: ignore
+
+schema_rejections = registry.counter(
+    "schema_rejections_total", "Payloads rejected by local schema validation", ("schema",)
+)
+
+
+class SchemaRegistry:
+    def __init__(self):
+        self.schemas: dict[tuple[str, str], dict] = {}
+        self.validators: dict[tuple[str, str], Validator] = {}
+        self.compiled: dict[tuple[str, str], Callable[[Any], Any] | None] = {}
+
+    def add(self, space_name: str, shortname: str, schema: dict) -> None:
+        self.schemas[(space_name, shortname)] = schema
+        self.validators.pop((space_name, shortname), None)
+        self.compiled.pop((space_name, shortname), None)
+
+    def load_folder(self, spaces_folder: str) -> None:
+        """Schemas of every space under `spaces_folder`, from their schema/.dm/{shortname}/meta.schema.json
+
+        What is missing is skipped with a warning, those payloads are left to DMART to validate.
+        """
+        if not os.path.isdir(spaces_folder):
+            logger.warning(f"No spaces folder at {os.path.abspath(spaces_folder)}, payloads are not validated locally")
+            return
+        for space_name in sorted(os.listdir(spaces_folder)):
+            schema_meta = os.path.join(spaces_folder, space_name, "schema", ".dm")
+            if not os.path.isdir(schema_meta):
+                continue
+            for shortname in sorted(os.listdir(schema_meta)):
+                meta_path = os.path.join(schema_meta, shortname, "meta.schema.json")
+                if not os.path.isfile(meta_path):
+                    continue
+                with open(meta_path) as file:
+                    body = json.load(file).get("payload", {}).get("body")
+                if not isinstance(body, str):
+                    continue
+                body_path = os.path.join(spaces_folder, space_name, "schema", body)
+                if not os.path.isfile(body_path):
+                    logger.warning(f"Schema {space_name}/{shortname} has no body at {body_path}, skipped")
+                    continue
+                with open(body_path) as file:
+                    self.add(space_name, shortname, json.load(file))
+
+    async def load_dmart(self, query: Callable[[QueryRequest], Awaitable[ApiResponse]], space_names: list[str]) -> None:
+        for space_name in space_names:
+            response = await query(QueryRequest(
+                type=QueryType.search,
+                space_name=space_name,
+                subpath="schema",
+                filter_types=[ResourceType.schema],
+                search="",
+                retrieve_json_payload=True,
+                limit=1000,
+            ))
+            for record in response.records:
+                body = (record.attributes or {}).get("payload", {}).get("body")
+                if isinstance(body, dict):
+                    self.add(space_name, record.shortname, body)
+
+    def validator(self, space_name: str, shortname: str) -> Validator | None:
+        """The compiled validator of a schema, None when it is not known here"""
+        key = (space_name, shortname)
+        validator = self.validators.get(key)
+        if validator is None and key in self.schemas:
+            schema = self.schemas[key]
+            cls = validator_for(schema)
+            cls.check_schema(schema)
+            validator = self.validators[key] = cls(schema, format_checker=cls.FORMAT_CHECKER)
+            self.compiled[key] = compile_fast(schema)
+        return validator
+
+    def validate(self, space_name: str, shortname: str, body: Any) -> None:
+        """Raises the jsonschema ValidationError that best describes what is wrong with `body`
+
+        Payloads of schemas that are not known here are left to DMART.
+        """
+        validator = self.validator(space_name, shortname)
+        if validator is None:
+            return
+        fast = self.compiled.get((space_name, shortname))
+        if fast is not None and fastjsonschema is not None:
+            try:
+                fast(body)
+                return
+            except fastjsonschema.JsonSchemaValueException:
+                pass
+        elif validator.is_valid(body):
+            return
+        error = best_match(validator.iter_errors(body))
+        if error is not None:
+            schema_rejections.inc(shortname)
+            raise error
+
+
+def compile_fast(schema: dict) -> Callable[[Any], Any] | None:
+    if fastjsonschema is None:
+        return None
+    try:
+        return cast(Callable[[Any], Any], fastjsonschema.compile(schema))
+    except fastjsonschema.JsonSchemaDefinitionException:
+        # Features it does not support, jsonschema validates these alone
+        return None
+
+
+schema_registry = SchemaRegistry()
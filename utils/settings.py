@@ -10,13 +10,42 @@ class Settings(BaseSettings):
     log_handlers: list[str] = ['console','file'] 
     log_file: str = "./logs/dmart.ljson.log"
     debug_enabled: bool = True
+    log_async_enabled: bool = True  # Format and write log records on a background thread
+    log_queue_size: int = 10000
+    log_queue_overflow: str = "drop"  # block | drop | sample
+    log_queue_sample_rate: float = 0.1  # Fraction of INFO records kept by "sample" when the queue is half full
+    log_batch_size: int = 256
+    log_masked_keys: list[str] = ['password', 'access_token', 'refresh_token', 'auth_token']
+    log_sample_rates: dict[str, float] = {}  # Status class ("2xx".."5xx") -> fraction of requests logged, default 1
+    request_log_max_bytes: int = 16384  # Serialized request body kept for logging, larger ones are truncated
+    response_log_max_bytes: int = 65536  # Response body prefix kept for logging
+    response_log_routes: dict[str, int] = {"/attachments/": 0}  # Path regex -> bytes kept for logging (0 disables capture)
+    response_log_content_types: dict[str, int] = {
+        "application/octet-stream": 0,
+        "application/x-ndjson": 0,
+        "text/event-stream": 0,
+    }
+
+    # Response compression
+    compression_encodings: list[str] = ["zstd", "br", "gzip", "deflate"]  # By preference, [] disables compression
+    compression_levels: dict[str, int] = {"gzip": 6, "deflate": 6, "br": 4, "zstd": 3}
+    compression_content_types: dict[str, int] = {  # Content type prefix -> smallest body compressed, others are sent as is
+        "application/json": 1024,
+        "application/x-ndjson": 0,
+        "application/problem+json": 1024,
+        "text/": 1024,
+        "image/svg+xml": 1024,
+        "application/javascript": 1024,
+    }
+    compression_thread_min_size: int = 256 * 1024  # Bodies at least this big are compressed off the event loop
 
     # API settings
+    json_backend: str = "orjson"  # orjson | stdlib, stdlib is used when orjson is not installed
     app_name: str = "Dmart MicroService"
     listening_host: str = "0.0.0.0"
     listening_port: int = 8989
     request_timeout: int = 35  # In seconds the time of dmart requests.
-    channels: list = []
+    channels: list = []  # Entries may set "rate_limit" and "user_rate_limit": {"rate": per second, "burst": n}
     servername: str = ""  # This is for print purposes only.
 
     base_path: str = ""
@@ -24,11 +53,75 @@ class Settings(BaseSettings):
     jwt_secret: str = ""
     jwt_algorithm: str = "HS256"
     jwt_access_expires: int = 86400 * 30
+    jwt_cache_size: int = 10000  # Verified tokens kept in memory, 0 disables the cache
+    jwt_cache_ttl: int = 300  # Upper bound in seconds, entries never outlive the token's expires claim
+
+    # DMART query cache
+    query_cache_max_entries: int = 1000  # 0 disables the cache
+    query_cache_ttl: int = 30  # In seconds
+    query_cache_ttls: dict[str, int] = {}  # "space" or "space/subpath" -> ttl in seconds
+    query_cache_generations_file: str = "./logs/query_cache_generations.bin"  # Write counters shared by the workers, empty keeps them per process
+    query_cache_generation_slots: int = 65536
+
+    # Local payload validation
+    schemas_source: str = "folder"  # folder | dmart | none, where the schemas validated against locally come from
+    spaces_folder: str = "./spaces"  # Read by the "folder" source
+    schema_spaces: list[str] = ["dummy_space"]  # Spaces whose schemas the "dmart" source loads
+
+    # Dummy listing
+    dummy_page_max_limit: int = 1000
+    dummy_stream_page_size: int = 500  # Records fetched from DMART per page by the NDJSON stream
+
+    # Dummy batch endpoints
+    dummy_batch_max_records: int = 10000
+    dummy_batch_chunk_size: int = 100  # Records per ActionRequest
+    dummy_batch_concurrency: int = 4  # Chunks sent to DMART at the same time
+
+    # Attachments
+    attachment_max_bytes: int = 4 * 1024 ** 3  # Largest attachment accepted for upload
+    attachment_chunk_size: int = 64 * 1024  # Bytes per read when relaying a download
+    attachment_transfer_timeout: int = 3600  # In seconds, replaces request_timeout for attachment uploads
 
     # Dmart Creds
     dmart_base_url:str=""
     dmart_username:str=""
     dmart_password:str=""
+    dmart_coalesce_queries: bool = True  # Identical in-flight queries share one upstream call
+    dmart_pool_size: int = 100  # Open connections to DMART per worker, 0 means no limit
+    dmart_pool_per_host: int = 0  # 0 leaves only dmart_pool_size
+    dmart_keepalive_timeout: float = 30  # Idle connections are kept open this long, in seconds
+    dmart_dns_cache_ttl: int = 300  # In seconds
+    dmart_connect_timeout: float = 5  # In seconds
+    dmart_read_timeout: float = 30  # In seconds, the longest wait for data on an open connection
+    dmart_token_refresh_margin: int = 300  # In seconds, the session is renewed this long before its token expires
+    dmart_limit_initial: int = 20  # Concurrent DMART calls per worker, adapted to the observed latency
+    dmart_limit_min: int = 2
+    dmart_limit_max: int = 200
+    dmart_limit_tolerance: float = 2.0  # Calls slower than this multiple of the best recent latency shrink the limit
+    dmart_queue_size: int = 200  # Calls waiting for a slot, more are failed with a 503
+    dmart_queue_timeout: float = 5  # In seconds
+    dmart_breaker_failures: int = 5  # Consecutive upstream failures that open the circuit, 0 disables it
+    dmart_breaker_reset_timeout: float = 10  # In seconds before a probe call is let through
+    dmart_min_call_time: float = 0.05  # In seconds, calls are not started with less of the request time left
+
+    # Password hashing (Argon2)
+    password_hash_memory_cost: int = 102400  # In KiB, taken by every hash while it runs
+    password_hash_time_cost: int = 1
+    password_hash_parallelism: int = 8
+    password_hash_concurrency: int = 2  # Hashes computed at the same time
+    password_hash_queue_size: int = 64  # Hashes waiting for a turn before new ones get a 503
+    password_hash_queue_timeout: float = 5  # In seconds
+    password_hash_executor: str = "thread"  # thread | process
+
+    # Rate limiting, the limits themselves are set per channel
+    user_rate_limit: dict = {}  # {"rate": per second, "burst": n} for users whose channel sets none, empty disables
+    rate_limit_file: str = "./logs/rate_limits.bin"  # Buckets shared by the workers of the host
+    rate_limit_slots: int = 65536  # Buckets kept, least recently used ones are reset when full
+
+    # Metrics
+    metrics_dir: str = "./logs/metrics"  # Per worker snapshots merged by /metrics, empty keeps metrics per process
+    metrics_publish_interval: float = 5  # In seconds
+    metrics_loop_lag_interval: float = 0.25  # In seconds, 0 disables the event loop lag probe
 
 
     # Environment file loading configuration
@@ -0,0 +1,180 @@
+import asyncio
+from collections import deque
+from time import monotonic
+
+from fastapi import status
+from pydmart.models import DmartException
+from pydmart.models import Error as DmartError
+
+from utils.internal_error_code import InternalErrorCode
+
+
+def unavailable(message: str) -> DmartException:
+    return DmartException(
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        DmartError(type="dmart", code=InternalErrorCode.UPSTREAM_UNAVAILABLE, message=message),
+    )
+
+
+def no_time_left() -> DmartException:
+    """The request ran out of time before DMART was called, which says nothing about DMART"""
+    return DmartException(
+        status.HTTP_504_GATEWAY_TIMEOUT,
+        DmartError(
+            type="dmart",
+            code=InternalErrorCode.REQUEST_TIME_EXHAUSTED,
+            message="Not enough of the request time left to call DMART",
+        ),
+    )
+
+
+def out_of_time(message: str) -> DmartException:
+    return DmartException(
+        status.HTTP_504_GATEWAY_TIMEOUT,
+        DmartError(type="dmart", code=InternalErrorCode.UPSTREAM_TIMEOUT, message=message),
+    )
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for upstream calls, driven by their latency
+
+    The limit grows by about one per limit-sized batch of calls answered close to the best
+    recent latency of their operation, and shrinks by `decrease` when a call fails or takes
+    longer than `tolerance` times that latency. Each operation has its own baseline so slow
+    batch writes are not measured against fast reads. Calls over the limit wait in a
+    bounded FIFO queue.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int,
+        maximum: int,
+        tolerance: float,
+        queue_size: int,
+        queue_timeout: float,
+        decrease: float = 0.9,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.decrease = decrease
+        self.in_flight = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.best_latency: dict[str, float] = {}
+        self.decreased_at = 0.0
+        self.rejected = {"queue_full": 0, "queue_timeout": 0}
+
+    def has_room(self) -> bool:
+        return self.in_flight < max(1, int(self.limit))
+
+    async def acquire(self, timeout: float | None = None) -> float:
+        """Waits for a slot at most `timeout` (default queue_timeout), returns the time the call may start at"""
+        if self.has_room() and not self.waiters:
+            self.in_flight += 1
+            return monotonic()
+        if len(self.waiters) >= self.queue_size:
+            self.rejected["queue_full"] += 1
+            raise unavailable("DMART is overloaded, too many calls waiting")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            async with asyncio.timeout(self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)):
+                await future
+        except TimeoutError:
+            if not future.done() or future.cancelled():
+                self.rejected["queue_timeout"] += 1
+                raise unavailable("DMART is overloaded, timed out waiting for a slot")
+            # The slot was handed over just as the wait ran out, use it
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we were cancelled, pass it on
+                self.release(None, 0.0, False)
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            if future in self.waiters:
+                self.waiters.remove(future)
+        return monotonic()
+
+    def release(self, latency: float | None, started: float, failed: bool, operation: str = "") -> None:
+        """`latency` is None for calls that were cancelled or never sent, they do not move the limit"""
+        self.in_flight -= 1
+        if latency is not None:
+            self.adjust(operation, latency, started, failed)
+        while self.waiters and self.has_room():
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def adjust(self, operation: str, latency: float, started: float, failed: bool) -> None:
+        best = self.best_latency.get(operation)
+        if not failed:
+            # The best latency drifts up slowly so a lasting change upstream becomes the new normal
+            best = self.best_latency[operation] = latency if best is None else min(latency, best * 1.001)
+        congested = failed or (best is not None and latency > best * self.tolerance)
+        if congested:
+            # One decrease per round trip: calls that started before the last one add nothing new
+            if started >= self.decreased_at:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.decreased_at = monotonic()
+        elif self.in_flight + 1 >= self.limit / 2:
+            # Only grow when the limit is actually being used
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            **self.rejected,
+        }
+
+
+class CircuitBreaker:
+    """Fails calls fast after `failures` consecutive upstream failures
+
+    After `reset_timeout` seconds one probe call is let through (half open), its outcome
+    closes the circuit again or restarts the wait. `failures` 0 disables the breaker.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, failures: int, reset_timeout: float):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+
+    def before_call(self) -> None:
+        if self.state == self.OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.probing):
+            self.rejected += 1
+            raise unavailable("DMART is unavailable, failing fast until it recovers")
+        if self.state == self.HALF_OPEN:
+            self.probing = True
+
+    def record(self, ok: bool | None) -> None:
+        """`ok` is None for calls that were cancelled"""
+        if self.state == self.HALF_OPEN:
+            self.probing = False
+        if ok is None:
+            return
+        if ok:
+            self.consecutive = 0
+            self.state = self.CLOSED
+            return
+        self.consecutive += 1
+        if self.failures and (self.state == self.HALF_OPEN or self.consecutive >= self.failures):
+            self.state = self.OPEN
+            self.opened_at = monotonic()